@@ -20,24 +20,21 @@
 
 from __future__ import print_function
 
-import time
 import logging
 import argparse
-import json
 import os
-from threading import Thread
 import mimetypes
 try:
     from urllib import unquote
 except ImportError:
     from urllib.parse import unquote
 
-from efl.ecore import Idler, Timer
+from efl.ecore import Timer
 
 import efl.evas as evas
 from efl.evas import Smart, SmartObject, FilledImage, EXPAND_BOTH, FILL_BOTH, \
     EVAS_CALLBACK_KEY_DOWN, EVAS_CALLBACK_KEY_UP, EVAS_CALLBACK_MOUSE_WHEEL, \
-    Rect, Rectangle, EXPAND_HORIZ, FILL_HORIZ, EVAS_EVENT_FLAG_ON_HOLD
+    Rectangle, EXPAND_HORIZ, FILL_HORIZ, EVAS_EVENT_FLAG_ON_HOLD
 
 ALIGN_LEFT = 0.0, 0.5
 ALIGN_RIGHT = 1.0, 0.5
@@ -58,8 +55,9 @@ from efl.elementary.toolbar import Toolbar, ELM_OBJECT_SELECT_MODE_NONE
 from efl.elementary.fileselector import Fileselector
 from efl.elementary.background import Background
 from efl.elementary.table import Table
-from efl.elementary.entry import Entry, utf8_to_markup
-from efl.elementary.panel import Panel, ELM_PANEL_ORIENT_LEFT
+from efl.elementary.entry import Entry, utf8_to_markup, markup_to_utf8
+from efl.elementary.panel import Panel, ELM_PANEL_ORIENT_LEFT, \
+    ELM_PANEL_ORIENT_RIGHT
 from efl.elementary.genlist import Genlist, GenlistItem, GenlistItemClass, \
     ELM_GENLIST_ITEM_TREE, ELM_GENLIST_ITEM_NONE, ELM_LIST_COMPRESS, \
     ELM_OBJECT_SELECT_MODE_ALWAYS
@@ -69,30 +67,68 @@ from efl.elementary.check import Check
 from efl.elementary.hover import Hover
 from efl.elementary.list import List, ELM_LIST_EXPAND
 
-import PyPDF2
-
-from xdg import BaseDirectory
-
 from .tabbedbox import Tabs, Tab
+from .prefetch import Prefetcher
+from .render import RENDERERS
+from . import scheduler
+from . import search
+from . import instrument
+from . import memory
+from . import parser as doc_parser
+from .positions import PositionStore
+from .registry import DocumentRegistry, OPENED
+from .cache import GeometryCache, RenderCache, PreviewCache
 
 log = logging.getLogger("lekha")
 
 
 class AppWindow(StandardWindow):
 
-    def __init__(self, doc_specs={}):
+    def __init__(self, settings=None):
         SCALE = elm_conf.scale
 
         self.docs = []
-        self.doc_specs = doc_specs
 
-        self.settings = {"scroll_by_page": False}
+        self.settings = {
+            "scroll_by_page": False,
+            "render_cache_mb": 64,
+            "preview_cache_mb": 256,
+            "prefetch_pages": 3,
+            "prefetch_mb": 32,
+            "renderer": "evas",
+            "parser": "thread",
+            "memory_overlay": False,
+            }
+        if settings:
+            self.settings.update(settings)
+
+        self.positions = PositionStore()
+        self.geometry_cache = GeometryCache()
+        self.render_cache = RenderCache(
+            self.settings["render_cache_mb"], lambda img: img.delete())
+        self.preview_cache = PreviewCache(self.settings["preview_cache_mb"])
+        self.renderer = RENDERERS[self.settings["renderer"]]()
+        self.parser = None
+        if self.settings["parser"] == "process":
+            self.parser = doc_parser.ParserPool()
+        self.scheduler = scheduler.Scheduler(self._foreground_owners)
+        self.documents = DocumentRegistry(self)
 
         super(AppWindow, self).__init__(
             "main", "Lekha",
             size=(400 * SCALE, 400 * SCALE),
             autodel=True)
 
+        # callbacks can only be added once the window exists
+        self.callback_delete_request_add(lambda x: self.positions_save())
+        self.callback_delete_request_add(lambda x: self.renderer.shutdown())
+        if self.parser is not None:
+            self.callback_delete_request_add(
+                lambda x: self.parser.shutdown())
+        self.callback_delete_request_add(lambda x: search.shutdown())
+        self.callback_delete_request_add(
+            lambda x: self.preview_cache.shutdown())
+
         main_box = self.main_box = Box(self, size_hint_weight=EXPAND_BOTH)
         self.resize_object_add(main_box)
 
@@ -114,10 +150,11 @@ class AppWindow(StandardWindow):
         tabs.callback_add(
             "tab,selected", lambda x, y: self.title_set(y.doc_title))
         def selected_cb(tabs, content):
-            for c in content.page_box:
-                c.changed()
+            content.viewport_update()
         tabs.callback_add(
             "tab,selected", selected_cb)
+        tabs.callback_add(
+            "tab,selected", lambda x, y: self.scheduler.reschedule())
         tabs.callback_add(
             "tab,deleted", lambda x, y: y.delete())
 
@@ -225,18 +262,15 @@ class AppWindow(StandardWindow):
         if doc_path.startswith("file://"):
             doc_path = unquote(doc_path[7:])
 
-        if doc_path in self.doc_specs:
-            doc_zoom, doc_pos = self.doc_specs[doc_path]
-            try:
-                assert isinstance(doc_zoom, float), "zoom is not float"
-                assert isinstance(doc_pos, list), "pos is not tuple"
-                assert len(doc_pos) == 4, "pos len is not 4"
-            except Exception as e:
-                log.warn(
-                    "document zoom and position could not be restored because: %r",
-                    e)
-                doc_pos = [0, 0, 0, 0]
-                doc_zoom = 1.0
+        try:
+            spec = self.positions.get(doc_path)
+        except Exception as e:
+            log.warn(
+                "document zoom and position could not be restored because: %r",
+                e)
+            spec = None
+        if spec is not None:
+            doc_zoom, doc_pos = spec
         else:
             doc_pos = [0, 0, 0, 0]
             doc_zoom = 1.0
@@ -250,6 +284,17 @@ class AppWindow(StandardWindow):
         doc.callback_add("title,changed", title_changed)
         self.tabs.append(tab)
 
+    def _foreground_owners(self):
+        content = self.tabs.currentContent
+        if content is None:
+            return ()
+        return content, content.shared
+
+    def positions_save(self):
+        for d in self.docs:
+            self.positions.put(d.doc_path, d.zoom, d.doc_pos)
+        self.positions.close()
+
     def _settings_open(self, obj, it):
         h = Hover(self)
         t = it.track_object
@@ -275,6 +320,17 @@ class AppWindow(StandardWindow):
             h.dismiss()
         chk.callback_changed_add(_scroll_by_page_cb)
 
+        l.item_append(None, chk)
+
+        chk = Check(self, text="Show Memory Use")
+        chk.state = self.settings["memory_overlay"]
+        def _memory_overlay_cb(obj):
+            self.settings["memory_overlay"] = obj.state
+            for doc in self.docs:
+                doc.memory_overlay_set(obj.state)
+            h.dismiss()
+        chk.callback_changed_add(_memory_overlay_cb)
+
         l.item_append(None, chk)
         l.go()
 
@@ -290,14 +346,6 @@ class OutLine(GenlistItemClass):
 ol_glic = OutLine(item_style="no_icon")
 
 
-class OutLineList(GenlistItemClass):
-
-    def text_get(self, gl, part, ol):
-        return
-
-oll_glic = OutLineList(item_style="no_icon")
-
-
 class Document(Table):
 
     """
@@ -307,29 +355,47 @@ class Document(Table):
     - title,changed
     """
 
+    #: Seconds without zoom changes before pages render at the new zoom
+    ZOOM_SETTLE = 0.25
+    #: Seconds between updates of the memory overlay
+    MEMORY_REFRESH = 1.0
+
     def __init__(self, parent, path, pos=None, zoom=1.0):
+        self.app = parent
         self.doc_path = path
+        self.shared = parent.documents.acquire(path)
         self._zoom = zoom
         self.doc_pos = pos
-        self.pages = []
-        self.doc = None
+        self.anchor = None
+        self.table = self.shared.table
         self.doc_title = os.path.splitext(os.path.basename(path))[0]
-        self.visible_pages = []
+        self.visible_range = None
+        self.prefetch_range = None
+        self.ol_pending = {}
+        self.zoom_timer = None
+        self.rest_timer = None
+        self.memory_notify = None
+        self.memory_timer = None
+        self.prefetcher = Prefetcher(
+            self.table, parent.settings["prefetch_pages"],
+            parent.settings["prefetch_mb"])
 
         super(Document, self).__init__(
             parent, size_hint_weight=EXPAND_BOTH, size_hint_align=FILL_BOTH)
 
         scr = self.scr = Scroller(
             self, size_hint_weight=EXPAND_BOTH, size_hint_align=FILL_BOTH)
-        scr.callback_scroll_add(self._scrolled)
-        self.pack(scr, 0, 0, 4, 1)
+        scr.callback_scroll_add(instrument.timed(self._scrolled, "callback"))
+        self.pack(scr, 0, 0, 5, 1)
         scr.show()
 
-        box = self.page_box = Box(
-            scr, size_hint_weight=EXPAND_BOTH, size_hint_align=(0.5, 0.0))
-        scr.content = box
+        layout = self.page_layout = PageLayout(
+            scr, self.table, self._page_new, zoom,
+            size_hint_weight=EXPAND_BOTH, size_hint_align=(0.5, 0.0))
+        scr.content = layout
 
-        self.on_resize_add(self._resized)
+        self.on_resize_add(
+            instrument.timed(self._resized, "callback", "Document._resized"))
 
         btn = Button(
             self, text="Toggle outlines", size_hint_align=ALIGN_LEFT)
@@ -378,6 +444,11 @@ class Document(Table):
         self.pack(zlbl, 3, 1, 1, 1)
         zlbl.show()
 
+        btn = Button(self, text="Search", size_hint_align=ALIGN_RIGHT)
+        btn.callback_clicked_add(self._search_toggle)
+        self.pack(btn, 4, 1, 1, 1)
+        btn.show()
+
         n = self.page_notify = Notify(scr, align=(0.02, 0.02))
         b = Box(n, horizontal=True, padding=(6, 0))
         n.content = b
@@ -410,42 +481,98 @@ class Document(Table):
         ol_gl.show()
 
         p.show()
+
+        sp = self.search_p = Panel(
+            self, orient=ELM_PANEL_ORIENT_RIGHT,
+            size_hint_weight=EXPAND_BOTH, size_hint_align=FILL_BOTH)
+        sp.hidden = True
+        scr.on_move_add(
+            lambda x: sp.move(x.pos[0] + x.size[0] * 0.65, x.pos[1]))
+        scr.on_resize_add(
+            lambda x: sp.resize(x.size[0] * 0.35, x.size[1]))
+
+        b = Box(sp, size_hint_weight=EXPAND_BOTH, size_hint_align=FILL_BOTH)
+        sp.content = b
+
+        e = self.search_e = Entry(
+            b, single_line=True, scrollable=True,
+            size_hint_weight=EXPAND_HORIZ, size_hint_align=FILL_HORIZ)
+        e.part_text_set("guide", "Search")
+        e.callback_activated_add(
+            lambda x: self.search(markup_to_utf8(x.entry_get())))
+        b.pack_end(e)
+        e.show()
+
+        l = self.search_lbl = Label(
+            b, size_hint_weight=EXPAND_HORIZ, size_hint_align=FILL_HORIZ)
+        b.pack_end(l)
+        l.show()
+
+        l = self.search_l = List(
+            b, size_hint_weight=EXPAND_BOTH, size_hint_align=FILL_BOTH)
+        b.pack_end(l)
+        l.show()
+
+        b.show()
+        sp.show()
         self.show()
 
-        def read_worker():
-            t1 = self.t1 = time.clock()
-            try:
-                self.doc = PyPDF2.PdfFileReader(path)
-                self.page_count = self.doc.getNumPages()
-            except Exception as e:
-                log.exception("Document could not be opened because: %r", e)
-                self.doc = None
-                self.display_error(e)
-                return
-            t2 = time.clock()
-            log.info("Reading the doc took: %f", t2-t1)
+        self.on_del_add(self._deleted)
 
-        t = Thread(target=read_worker)
-        t.daemon = True
-        t.start()
+        self.renderer = parent.scheduler.renderer(
+            self, parent.renderer, self._render_kind)
 
-        def worker_check(t):
-            if t.is_alive():
-                return True
-            elif self.doc and self.page_count:
-                spn.special_value_add(self.page_count, "Last")
-                spn.min_max = (1, self.page_count)
+        self.shared.view_add(self)
+
+        if parent.settings["memory_overlay"]:
+            self.memory_overlay_set(True)
 
-                if self.doc.isEncrypted:
-                    PasswordPrompt(self)
-                    return False
+    def shared_opened(self):
+        """Show the laid out document at the restored position"""
+        page_count = self.shared.page_count
+        self.spn.special_value_add(page_count, "Last")
+        self.spn.min_max = (1, page_count)
 
-                self.metadata_read()
-                self.populate_pages()
-                return False
+        if self.shared.metadata:
+            self.metadata_show(self.shared.metadata)
 
-        timer = Timer(0.2, worker_check, t)
-        self.parent.callback_delete_request_add(lambda x: timer.delete())
+        self.page_layout.table_changed()
+        if self.doc_pos is not None:
+            self.scr.region_show(*self.doc_pos)
+            self._anchor_update(self.doc_pos[1])
+        self.viewport_update()
+
+    def shared_encrypted(self):
+        PasswordPrompt(self)
+
+    def shared_pages_changed(self, pg_nums):
+        self.page_layout.pages_changed(pg_nums)
+        if self.anchor is not None and min(pg_nums) < self.anchor[0]:
+            self._anchor_show()
+        self.viewport_update()
+
+    def shared_outlines(self, outlines):
+        self.outlines_populate(outlines)
+        self.load_notify.content.pulse(False)
+        self.load_notify.hide()
+
+    def shared_error(self, exc):
+        self.display_error(exc)
+
+    @staticmethod
+    def _deleted(obj):
+        if obj.memory_timer is not None:
+            obj.memory_timer.delete()
+        if obj in obj.app.docs:
+            obj.app.docs.remove(obj)
+        obj.app.scheduler.owner_remove(obj)
+        obj.app.documents.release(obj.shared, obj)
+
+    def _render_kind(self, pg_num):
+        rng = self.visible_range
+        if rng is not None and rng[0] <= pg_num <= rng[1]:
+            return scheduler.VISIBLE
+        return scheduler.PREFETCH
 
     def display_error(self, exc):
         self.load_notify.content.delete()
@@ -455,103 +582,206 @@ class Document(Table):
         self.load_notify.content = l
         l.show()
 
-    def metadata_read(self):
-        try:
-            info = self.doc.getDocumentInfo()
-        except Exception:
-            log.warn("Metadata information could not be extracted from the document")
-            return
-        else:
-            if not info:
-                log.warn("Metadata information could not be extracted from the document")
-                return
-
-            log.info(
-                "%s %s %s %s %s",
-                info.title, info.author, info.subject, info.creator, info.producer)
+    def metadata_show(self, info):
+        log.info(
+            "%s %s %s %s %s",
+            *[info[name] for name in doc_parser.METADATA_FIELDS])
 
-            if info.title:
-                self.doc_title = "{0}".format(info.title)
-            self.callback_call("title,changed", self.doc_title)
-
-    def populate_pages(self):
-        try:
-            itr = iter(xrange(self.page_count))
-        except Exception:
-            itr = iter(range(self.page_count))
-        idler = Idler(self.populate_page, self.doc, itr)
-        self.parent.callback_delete_request_add(lambda x: idler.delete())
+        if info["title"]:
+            self.doc_title = info["title"]
+        self.callback_call("title,changed", self.doc_title)
 
     def outlines_populate(self, outlines, parent=None):
         for outline in outlines:
-            if isinstance(outline, list):
-                GenlistItem(oll_glic, outline, parent, ELM_GENLIST_ITEM_TREE).append_to(self.ol_gl)
+            if outline.expandable:
+                flags = ELM_GENLIST_ITEM_TREE
             else:
-                GenlistItem(ol_glic, outline, parent, ELM_GENLIST_ITEM_NONE, self._outline_clicked_cb, outline).append_to(self.ol_gl)
+                flags = ELM_GENLIST_ITEM_NONE
+            GenlistItem(ol_glic, outline, parent, flags, self._outline_clicked_cb, outline).append_to(self.ol_gl)
 
     @staticmethod
     def _gl_contract_req(gl, it):
         it.expanded = False
 
-    @staticmethod
-    def _gl_contracted(gl, it):
+    def _gl_contracted(self, gl, it):
+        # children still being read must not go under a deleted item
+        for pending, ancestors in list(self.ol_pending.items()):
+            if pending is it or it in ancestors:
+                del self.ol_pending[pending]
         it.subitems_clear()
 
     @staticmethod
     def _gl_expand_req(gl, it):
         it.expanded = True
 
-    def _gl_expanded(self, gl, it):
-        self.outlines_populate(it.data, it)
-
-    def populate_page(self, doc, itr):
-        try:
-            pg_num = next(itr)
-            pg = doc.getPage(pg_num)
-        except StopIteration:
-            if self.doc_pos is not None:
-                self.scr.region_show(*self.doc_pos)
-
-            def outlines_get():
-                self.outlines = doc.outlines
-
-            t1 = time.clock()
-            t = Thread(target=outlines_get)
-            t.daemon = True
-            t.start()
-
-            def check_outlines(t):
-                if t.is_alive():
-                    return True
-                t2 = time.clock()
-                log.info("Fetching outlines took: %f", t2-t1)
-                self.outlines_populate(self.outlines)
-                self.load_notify.content.pulse(False)
-                self.load_notify.hide()
-
-            self.outlines_timer = Timer(0.2, check_outlines, t)
-
+    def memory(self):
+        """Memory used by the tab
+
+        Returns a dict of the decoded page image bytes by resolution
+        level under images, the counts of Page objects under pages and
+        the memory of the file, shared with its other tabs, under shared.
+        """
+        layout = self.page_layout
+        images = dict.fromkeys(memory.LEVELS, 0)
+        for page in layout.pages():
+            for level, nbytes in page.memory().items():
+                images[level] += nbytes
+        return {
+            "images": images,
+            "pages": {
+                "realized": len(layout.realized),
+                "recycled": len(layout.recycled),
+                },
+            "shared": self.shared.memory(),
+            }
+
+    def memory_overlay_set(self, enabled):
+        """Show or hide the memory use of the tab over the pages"""
+        if self.memory_timer is not None:
+            self.memory_timer.delete()
+            self.memory_timer = None
+        if not enabled:
+            if self.memory_notify is not None:
+                self.memory_notify.hide()
+            return
+        if self.memory_notify is None:
+            n = self.memory_notify = Notify(self.scr, align=(0.98, 0.02))
+            l = Label(n, style="marker")
+            n.content = l
+            l.show()
+        self._memory_update()
+        self.memory_notify.show()
+        self.memory_timer = Timer(
+            self.MEMORY_REFRESH,
+            instrument.timed(self._memory_update, "timer"))
+
+    def _memory_update(self):
+        if self.is_deleted():
             return False
+        self.memory_notify.content.text = "<br>".join(
+            memory.lines(self.memory()))
+        return True
+
+    def _search_toggle(self, btn):
+        p = self.search_p
+        p.toggle()
+        if self.shared.state != OPENED:
+            return
+        self.shared.search_index().start(self._search_progress)
+        self.search_e.focus = True
 
-        mbox = pg.mediaBox
-        w, h = mbox[2], mbox[3]
+    def _search_progress(self, indexed, total):
+        if self.is_deleted():
+            return
+        if indexed < total:
+            self.search_lbl.text = "Indexed %d of %d pages" % (indexed, total)
+        elif self.search_e.entry_get():
+            self.search(markup_to_utf8(self.search_e.entry_get()))
+        else:
+            self.search_lbl.text = ""
 
-        box = self.page_box
+    def search(self, query):
+        """List the pages containing all the words of query"""
+        if self.shared.state != OPENED:
+            return
+        index = self.shared.search_index()
+        index.start(self._search_progress)
+        results = index.search(query)
+
+        l = self.search_l
+        l.clear()
+        for pg_num, hits in results:
+            l.item_append(
+                "Page %d (%d hits)" % (pg_num + 1, hits), None, None,
+                self._search_clicked_cb, pg_num)
+        l.go()
 
-        page = Page(box, self.doc_path, pg_num, w, h, self.zoom)
-        page.callback_add("viewport,in", self._viewport_in, self.page_notify)
-        page.callback_add("viewport,out", self._viewport_out, self.page_notify)
-        box.pack_end(page)
-        page.show()
+        text = "%d pages" % len(results)
+        if not index.complete:
+            text += ", indexed %d of %d" % (index.indexed, index.page_count)
+        self.search_lbl.text = text
 
-        self.pages.append((pg.indirectRef.idnum, page))
+    def _search_clicked_cb(self, l, it, pg_num):
+        self.page_show_by_num(pg_num)
 
-        return True
+    def _gl_expanded(self, gl, it):
+        ancestors = []
+        parent = it.parent_item
+        while parent is not None:
+            ancestors.append(parent)
+            parent = parent.parent_item
+        self.ol_pending[it] = ancestors
+        self.shared.outline_children(
+            it.data, lambda children: self._outline_children(it, children))
+
+    def _outline_children(self, it, children):
+        if self.is_deleted() or self.ol_pending.pop(it, None) is None:
+            return
+        self.outlines_populate(children, it)
+
+    def _page_new(self, layout, pg_num, w, h):
+        page = Page(
+            layout, self.shared.path, pg_num, w, h, layout.render_zoom,
+            self.app.render_cache, self.app.preview_cache,
+            self.shared.fingerprint,
+            self.renderer)
+        page.callback_add(
+            "viewport,in", instrument.timed(self._viewport_in, "callback"),
+            self.page_notify)
+        page.callback_add(
+            "viewport,out", instrument.timed(self._viewport_out, "callback"),
+            self.page_notify)
+        return page
+
+    def viewport_update(self):
+        """Realize the pages near the viewport and update their visibility
+
+        The visible range is found by bisecting the page offsets, and only
+        the pages whose visibility changed get viewport,in or viewport,out.
+        """
+        x, y, w, h = self.scr.region
+        layout = self.page_layout
+        z = self.zoom
+        visible = self.table.range_between(y / z, (y + h) / z)
+        ahead = self.prefetcher.range(visible, z)
+        layout.viewport_set(y, h, ahead)
+
+        old = self.visible_range
+        self.visible_range = visible
+
+        if old is not None:
+            for pg_num in range(old[0], old[1] + 1):
+                if visible is None or not visible[0] <= pg_num <= visible[1]:
+                    page = layout.realized.get(pg_num)
+                    if page is not None and page.in_viewport:
+                        page.viewport_leave()
+
+        if visible is not None:
+            for pg_num in range(visible[0], visible[1] + 1):
+                page = layout.realized[pg_num]
+                if not page.in_viewport:
+                    page.viewport_enter()
+                if page.tiled and page.zoom == z:
+                    px, py, pw, ph = layout.page_geometry(pg_num)
+                    page.tiles_update(x - px, y - py, w, h)
+
+        old = self.prefetch_range
+        self.prefetch_range = ahead
+
+        if old is not None:
+            for pg_num in range(old[0], old[1] + 1):
+                if ahead is None or not ahead[0] <= pg_num <= ahead[1]:
+                    page = layout.realized.get(pg_num)
+                    if page is not None and not page.in_viewport:
+                        page.render_stop()
+
+        if ahead is not None:
+            for pg_num in range(ahead[0], ahead[1] + 1):
+                layout.realized[pg_num].prefetch()
 
     @staticmethod
     def _resized(obj):
-        for page in obj.page_box:
-            page.changed()
+        obj.viewport_update()
 
     @property
     def zoom(self):
@@ -559,10 +789,29 @@ class Document(Table):
 
     @zoom.setter
     def zoom(self, value):
-        for c in self.page_box:
-            c.zoom_set(value)
+        smallest = self.table.smallest
+        if (
+                smallest is not None and value < self._zoom and
+                smallest * value < Page.SIZE_MIN):
+            return
         self._zoom = value
+        self.page_layout.zoom_set(value)
         self.zlbl.text = "%1.0f %%" % (value * 100.0)
+        self.viewport_update()
+
+        if self.zoom_timer is not None:
+            self.zoom_timer.delete()
+        self.zoom_timer = Timer(
+            self.ZOOM_SETTLE, instrument.timed(self._zoom_settled, "timer"))
+
+    def _zoom_settled(self):
+        self.zoom_timer = None
+        if self.is_deleted():
+            return False
+        self.page_layout.render_zoom_set(self._zoom)
+        self.viewport_update()
+        self.app.positions.put(self.doc_path, self._zoom, self.doc_pos)
+        return False
 
     def zoom_in(self, value=0.2):
         self.zoom += value
@@ -574,11 +823,7 @@ class Document(Table):
         self.zoom = 1.0
 
     def zoom_fit(self):
-        widest = 0
-        for c in self.page_box:
-            pw = c.size[0]
-            if pw > widest:
-                widest = pw
+        widest = self.table.widest * self.zoom
 
         if widest == 0:
             log.error("Widest page has width of 0!")
@@ -590,8 +835,15 @@ class Document(Table):
 
         self.zoom *= viewport_width/widest
 
+    @property
+    def visible_pages(self):
+        """Page numbers in the viewport, in document order"""
+        rng = self.visible_range
+        if rng is None:
+            return range(0)
+        return range(rng[0], rng[1] + 1)
+
     def _viewport_in(self, obj, ei, n):
-        self.visible_pages.append(obj.page_num)
         l = obj.page_num_label
         b = n.content
         b.pack_end(l)
@@ -600,7 +852,6 @@ class Document(Table):
         n.show()
 
     def _viewport_out(self, obj, ei, n):
-        self.visible_pages.remove(obj.page_num)
         l = obj.page_num_label
         b = n.content
         b.unpack(l)
@@ -613,43 +864,108 @@ class Document(Table):
         self.page_show_by_num(pg_num)
 
     def _outline_clicked_cb(self, glit, gl, ol):
-        if ol.typ == "/Fit":
-            self.page_show_by_id(ol.page.idnum)
-        elif ol.typ == "/XYZ":
-            self.page_show_by_id(ol.page.idnum, ol.left, ol.top)
-        else:
-            self.page_show_by_id(ol.page.idnum)
-        # /FitH      [top]
-        # /FitV      [left]
-        # /FitR      [left] [bottom] [right] [top]
-        # /FitB      No additional arguments
-        # /FitBH     [top]
-        # /FitBV     [left]
+        dest = self.shared.destination(ol)
+        if dest is not None:
+            self.destination_show(*dest)
+
+    def destination_show(self, pg_num, typ, args):
+        """Show a destination of the given fit type, see parser.FIT_TYPES
+
+        PDF coordinates grow from the bottom of the page, offsets into the
+        page from its top. The bounding box fits (/FitB, /FitBH and
+        /FitBV) use the whole page, as the bounding box of the contents
+        is not known.
+        """
+        w, h = self.table.size(pg_num)
+        if w <= 0 or h <= 0:
+            self.page_show(pg_num)
+            return
+        vw, vh = self.scr.region[2:]
+        args = tuple(args) + (None,) * (4 - len(args))
+        left = top = zoom = None
+
+        if typ == "/XYZ":
+            left, top, zoom = args[:3]
+        elif typ in ("/Fit", "/FitB"):
+            zoom = min(vw / w, vh / h)
+        elif typ in ("/FitH", "/FitBH"):
+            top = args[0]
+            zoom = vw / w
+        elif typ in ("/FitV", "/FitBV"):
+            left = args[0]
+            zoom = vh / h
+        elif typ == "/FitR":
+            l, b, r, t = args
+            if None not in args and r > l and t > b:
+                left, top = l, t
+                zoom = min(vw / (r - l), vh / (t - b))
+
+        if zoom:
+            self.zoom = zoom
+        z = self.zoom
+        offset_x = max(left * z, 0) if left is not None else 0
+        offset_y = max((h - top) * z, 0) if top is not None else 0
+        self.page_show(pg_num, offset_x, offset_y)
 
     def page_show_by_id(self, page_id, offset_x=0, offset_y=0):
-        for id_num, pg in self.pages:
-            if page_id == id_num:
-                self.page_show(pg, offset_x, offset_y)
-                break
+        pg_num = self.table.page_num(page_id)
+        if pg_num is not None:
+            self.page_show(pg_num, offset_x, offset_y)
 
     def page_show_by_num(self, pg_num):
         if pg_num < 0:
             pg_num = 0
-        elif pg_num > self.page_count - 1:
-            pg_num = -1
-        pg_id, pg = self.pages[pg_num]
-        self.page_show(pg)
+        elif pg_num > len(self.table) - 1:
+            pg_num = len(self.table) - 1
+        if pg_num < 0:
+            return
+        self.page_show(pg_num)
 
-    def page_show(self, pg, offset_x=0, offset_y=0):
+    def page_show(self, pg_num, offset_x=0, offset_y=0):
         x1, y1, w1, h1 = self.scr.region
-        x2, y2, w2, h2 = pg.geometry
-        x3, y3 = self.scr.pos
-        new_x = x1 + x2 - x3 + offset_x
-        new_y = y1 + y2 - y3 + offset_y
+        x2, y2, w2, h2 = self.page_layout.page_geometry(pg_num)
+        new_x = x2 + offset_x
+        new_y = y2 + offset_y
+        self.anchor = pg_num, offset_y / self.zoom
         self.scr.region_show(new_x, new_y, 0, h1)
 
+    def _anchor_update(self, y):
+        """Remember the page and offset at the top of the viewport"""
+        y /= self.zoom
+        pg_num = self.table.page_at(y)
+        if pg_num is None:
+            self.anchor = None
+        else:
+            self.anchor = pg_num, y - self.table.offsets[pg_num]
+
+    def _anchor_show(self):
+        """Scroll back to the anchor after the pages above it moved"""
+        pg_num, offset = self.anchor
+        x, y, w, h = self.scr.region
+        y = (self.table.offsets[pg_num] + offset) * self.zoom
+        self.scr.region_show(x, int(y), w, h)
+
     def _scrolled(self, scr):
         self.doc_pos = scr.region
+        self._anchor_update(self.doc_pos[1])
+        self.app.positions.put(self.doc_path, self.zoom, self.doc_pos)
+        self.prefetcher.scrolled(self.doc_pos[1])
+        self.viewport_update()
+        # no scroll event tells when the view stops, shrink the prefetch
+        # range once the scroll speed has faded out
+        if self.rest_timer is None:
+            self.rest_timer = Timer(
+                Prefetcher.LOOKAHEAD,
+                instrument.timed(self._scroll_rested, "timer"))
+        else:
+            self.rest_timer.reset()
+
+    def _scroll_rested(self):
+        self.rest_timer = None
+        if self.is_deleted():
+            return False
+        self.viewport_update()
+        return False
 
     def scroll_freeze(self):
         self.scr.scroll_freeze_push()
@@ -661,49 +977,186 @@ class Document(Table):
         return self.scr.scroll_freeze
 
 
-class PageSmart(Smart):
+@instrument.smart
+class PageLayoutSmart(Smart):
+
+    def calculate(self, obj):
+        obj.pages_position()
+
+    def resize(self, obj, w, h):
+        obj.clipper.resize(w, h)
+        obj.changed()
+
+    def move(self, obj, x, y):
+        obj.clipper.move(x, y)
+        obj.pages_position()
 
     @staticmethod
-    def check_visibility(obj, x, y, w, h):
-        r1 = Rect(x, y, w, h)
-        r2 = obj.parent.parent.rect
-        hq_img = obj.hq_img
-        pv_img = obj.pv_img
-
-        if r1.intersects(r2):
-            if obj.in_viewport is True:
-                return
-            obj.in_viewport = True
-            obj.callback_call("viewport,in")
-            pv_img.file = (obj.doc_path, str(obj.page_num))
-            pv_img.preload()
-            log.debug("preloading pv %d %r %r", obj.page_num, r1, r2)
+    def show(obj):
+        if obj.clipper.clipees:
+            obj.clipper.show()
+
+    @staticmethod
+    def hide(obj):
+        obj.clipper.hide()
+
+    @staticmethod
+    def clip_set(obj, clip):
+        obj.clipper.clip_set(clip)
+
+    @staticmethod
+    def clip_unset(obj):
+        obj.clipper.clip_unset()
+
+    @staticmethod
+    def delete(obj):
+        for page in obj.pages():
+            page.delete()
+        obj.clipper.delete()
+
+
+class PageLayout(SmartObject):
+
+    """Virtualized layout of the pages of a document
+
+    Only the pages near the viewport have a Page object, the rest of the
+    document is represented by the sizes in the page table. Page objects
+    that leave the realized range are recycled for the ones entering it.
+    """
+
+    SMART = PageLayoutSmart()
+
+    #: Part of the viewport height realized above and below it
+    REALIZE_MARGIN = 1.0
+
+    def __init__(self, parent, table, page_new_cb, zoom=1.0, **kwargs):
+        self.table = table
+        self.page_new_cb = page_new_cb
+        self.zoom = zoom
+        self.render_zoom = zoom
+        self.realized = {}
+        self.recycled = []
+
+        super(PageLayout, self).__init__(
+            parent.evas, self.SMART, parent=parent, **kwargs)
+
+        self.clipper = Rectangle(self.evas, color=(255, 255, 255, 255))
+        self.member_add(self.clipper)
+
+    def pages(self):
+        return list(self.realized.values()) + self.recycled
+
+    def table_changed(self):
+        z = self.zoom
+        self.size_hint_min = self.table.widest * z, self.table.height * z
+
+    def zoom_set(self, value):
+        """Change the display size of the pages, leaving their renders as is"""
+        self.zoom = value
+        self.table_changed()
+        self.changed()
+
+    def pages_changed(self, pg_nums):
+        """Update the layout to page sizes set in the table"""
+        self.table_changed()
+        for pg_num in pg_nums:
+            page = self.realized.get(pg_num)
+            if page is not None:
+                page.size_set(*self.table.size(pg_num))
+        self.changed()
+
+    def render_zoom_set(self, value):
+        self.render_zoom = value
+        for page in self.realized.values():
+            if page.zoom != value:
+                page.zoom_set(value)
+
+    def page_geometry(self, pg_num):
+        """Geometry of a page relative to the layout"""
+        z = self.zoom
+        w, h = self.table.size(pg_num)
+        w *= z
+        h *= z
+        x = (self.size[0] - w) / 2
+        y = self.table.offsets[pg_num] * z
+        return int(x), int(y), int(w), int(h)
+
+    def viewport_set(self, y, h, extra=None):
+        """Realize the pages around the viewport and the extra range"""
+        z = self.zoom
+        margin = h * self.REALIZE_MARGIN
+        rng = self.table.range_between((y - margin) / z, (y + h + margin) / z)
+        if extra is not None:
+            if rng is None:
+                rng = extra
+            else:
+                rng = min(rng[0], extra[0]), max(rng[1], extra[1])
+        if rng is None:
+            self.realize(0, -1)
         else:
-            if obj.in_viewport is False:
-                return
-            obj.in_viewport = False
-            obj.callback_call("viewport,out")
-            log.debug("hiding %d %r %r", obj.page_num, r1, r2)
-            for img in pv_img, hq_img:
-                img.image_data_set(None)
-                img.hide()
+            self.realize(*rng)
+
+    def realize(self, first, last):
+        for pg_num in list(self.realized):
+            if pg_num < first or pg_num > last:
+                page = self.realized.pop(pg_num)
+                page.unbind()
+                page.hide()
+                self.recycled.append(page)
+
+        for pg_num in range(first, last + 1):
+            if pg_num in self.realized:
+                continue
+            w, h = self.table.size(pg_num)
+            if self.recycled:
+                page = self.recycled.pop()
+                page.page_set(pg_num, w, h, self.render_zoom)
+            else:
+                page = self.page_new_cb(self, pg_num, w, h)
+                self.member_add(page)
+                page.clip = self.clipper
+                if self.visible:
+                    self.clipper.show()
+            self.realized[pg_num] = page
+            page.show()
 
-    def calculate(self, obj):
-        self.check_visibility(obj, *obj.geometry)
+        self.pages_position()
 
-    def resize(self, obj, w, h):
-        # x, y = obj.pos
-        #log.debug("resize %d %d", w, h)
+    def pages_position(self):
+        x, y = self.pos
+        for pg_num, page in self.realized.items():
+            px, py, pw, ph = self.page_geometry(pg_num)
+            page.resize(pw, ph)
+            page.move(x + px, y + py)
+
+
+@instrument.smart
+class PageSmart(Smart):
+
+    @staticmethod
+    def show(obj):
+        obj.bg.show()
+
+    @staticmethod
+    def hide(obj):
         for child in obj:
+            child.hide()
+
+    @staticmethod
+    def resize(obj, w, h):
+        #log.debug("resize %d %d", w, h)
+        for child in obj.page_members():
             child.resize(w, h)
-        # self.check_visibility(obj, x, y, w, h)
+        x, y = obj.pos
+        obj.tiles_position(x, y, w, h)
 
-    def move(self, obj, x, y):
+    @staticmethod
+    def move(obj, x, y):
         #log.debug("move %d %d", x, y)
-        w, h = obj.size
-        for child in obj:
+        for child in obj.page_members():
             child.move(x, y)
-        self.check_visibility(obj, x, y, w, h)
+        w, h = obj.size
+        obj.tiles_position(x, y, w, h)
 
     @staticmethod
     def clip_set(obj, clip):
@@ -719,22 +1172,46 @@ class PageSmart(Smart):
     def delete(obj):
         for child in obj:
             child.delete()
+        if obj._page_num_label is not None:
+            obj._page_num_label.delete()
 
 
 class Page(SmartObject):
 
     SMART = PageSmart()
     SIZE_MIN = 50
-
-    def __init__(self, parent, doc_path, page_num, w, h, zoom=1.0):
+    #: Zoom from which the page is rendered in tiles instead of hq_img
+    TILE_ZOOM = 2.0
+    TILE_SIZE = 512
+
+    def __init__(
+            self, parent, doc_path, page_num, w, h, zoom=1.0,
+            render_cache=None, preview_cache=None, fingerprint=None,
+            renderer=None):
         self.doc_path = doc_path
         self.page_num = page_num
         self.in_viewport = False
+        self.render_cache = render_cache
+        self.preview_cache = None
+        if fingerprint is not None:
+            self.preview_cache = preview_cache
+        self.fingerprint = fingerprint
+        if renderer is None:
+            renderer = RENDERERS["evas"]()
+        self.renderer = renderer
+        self.pv_from_disk = False
+        self.rendering = False
+        self.loaded = set()
+        self.tiled = False
+        self.tiles = {}
+        self.stand_in = None
+        self.zoom = zoom
 
         evas = parent.evas
         super(Page, self).__init__(evas, self.SMART, parent=parent)
 
-        self.page_num_label = Label(parent, text=str(page_num + 1))
+        self.label_parent = parent.parent
+        self._page_num_label = None
 
         self.bg = Rectangle(evas, color=(255, 255, 255, 255))
         self.member_add(self.bg)
@@ -743,51 +1220,330 @@ class Page(SmartObject):
         self.orig_w = float(w)
         self.orig_h = float(h)
 
-        w = float(w) * zoom
-        h = float(h) * zoom
+        self.pv_img = self._image_add()
+        self.hq_img = self._image_add()
+        self.zoom_set(zoom)
+
+        self.pass_events = True
 
-        self.pv_img = FilledImage(evas, load_dpi=1, load_size=(w/2, h/2))
-        self.member_add(self.pv_img)
+    @property
+    def page_num_label(self):
+        """Page number label, created the first time the page is seen"""
+        if self._page_num_label is None:
+            self._page_num_label = Label(
+                self.label_parent, text=str(self.page_num + 1))
+        return self._page_num_label
+
+    def _image_add(self, img=None):
+        if img is None:
+            img = FilledImage(self.evas, load_dpi=1)
+        self.member_add(img)
+        img.geometry = self.geometry
+        clip = self.clip
+        if clip is not None:
+            img.clip = clip
+        return img
+
+    def page_members(self):
+        """Members covering the whole page"""
+        members = [self.bg, self.pv_img, self.hq_img]
+        if self.stand_in is not None:
+            members.append(self.stand_in)
+        return members
+
+    def _image_restack(self):
+        self.pv_img.stack_above(self.bg)
+        below = self.pv_img
+        if self.stand_in is not None:
+            self.stand_in.stack_above(below)
+            below = self.stand_in
+        self.hq_img.stack_above(below)
+
+    def _stand_in_keep(self):
+        """Keep showing the current rendering while the page re-renders"""
+        for name in "hq_img", "pv_img":
+            if name in self.loaded:
+                break
+        else:
+            return
+        self._stand_in_drop()
+        img = self.stand_in = getattr(self, name)
+        new_img = self._image_add()
+        new_img.load_size = img.load_size
+        setattr(self, name, new_img)
+        self.loaded.discard(name)
+        self._image_restack()
+
+    def _stand_in_drop(self):
+        img = self.stand_in
+        if img is None:
+            return
+        self.stand_in = None
+        self.member_del(img)
+        img.clip_unset()
+        img.hide()
+        if self.render_cache is not None:
+            w, h = img.image_size
+            self.render_cache.put(self._cache_key(img), img, w * h * 4)
+        else:
+            img.delete()
+
+    def memory(self):
+        """Bytes of the decoded images by resolution level, see memory.LEVELS"""
+        usage = dict.fromkeys(memory.LEVELS, 0)
+        if "pv_img" in self.loaded:
+            usage["pv"] = memory.image_bytes(self.pv_img)
+        if "hq_img" in self.loaded:
+            usage["hq"] = memory.image_bytes(self.hq_img)
+        usage["tiles"] = sum(
+            memory.image_bytes(img) for img in self.tiles.values())
+        if self.stand_in is not None:
+            usage["stand_in"] = memory.image_bytes(self.stand_in)
+        return usage
+
+    def _cache_key(self, img):
+        w, h = img.load_size
+        return self.doc_path, self.page_num, w, h
+
+    def _cache_put(self, name):
+        """Move a rendered image to the render cache, put a blank one in its place"""
+        img = getattr(self, name)
+        self.member_del(img)
+        img.clip_unset()
+        img.hide()
+        w, h = img.image_size
+        new_img = self._image_add()
+        new_img.load_size = img.load_size
+        setattr(self, name, new_img)
+        self._image_restack()
+        self.render_cache.put(self._cache_key(img), img, w * h * 4)
+
+    def _cache_take(self, name):
+        """Replace an image with a rendering of it from the render cache"""
+        img = getattr(self, name)
+        cached = self.render_cache.take(self._cache_key(img))
+        if cached is None:
+            return False
+        self.renderer.cancel(img)
+        self.member_del(img)
+        img.delete()
+        setattr(self, name, self._image_add(cached))
+        self._image_restack()
+        self.loaded.add(name)
+        return True
 
-        self.pv_img.on_image_preloaded_add(self.pv_preloaded)
+    def viewport_enter(self):
+        self.in_viewport = True
+        self.callback_call("viewport,in")
+        self.render_start()
 
-        self.hq_img = FilledImage(evas, load_dpi=1, load_size=(w*2, h*2))
-        self.member_add(self.hq_img)
+    def viewport_leave(self):
+        self.in_viewport = False
+        self.callback_call("viewport,out")
+        log.debug("hiding %d", self.page_num)
+        self.render_stop()
+
+    def prefetch(self):
+        """Render the page ahead of it entering the viewport"""
+        if not self.rendering:
+            log.debug("prefetching %d", self.page_num)
+        self.render_start()
+
+    def render_start(self):
+        if self.rendering:
+            return
+        self.rendering = True
+        if self.render_cache is not None:
+            if (
+                    not self.tiled and
+                    self._cache_take("hq_img")):
+                log.debug("cached hq %d", self.page_num)
+                self._stand_in_drop()
+                self.hq_img.show()
+                return
+            if self._cache_take("pv_img"):
+                log.debug("cached pv %d", self.page_num)
+                self.pv_preloaded(self.pv_img)
+                return
+        self.pv_from_disk = False
+        if self.preview_cache is not None:
+            w, h = self.pv_img.load_size
+            path = self.preview_cache.lookup(
+                self.fingerprint, self.page_num, w, h)
+            if path is not None:
+                self.pv_from_disk = True
+                self.renderer.load(self.pv_img, path, self.pv_preloaded)
+                log.debug("preloading cached pv %d", self.page_num)
+                return
+        self.renderer.render(
+            self.pv_img, self.doc_path, self.page_num, self.pv_preloaded)
+        log.debug("preloading pv %d", self.page_num)
+
+    def render_stop(self):
+        """Cancel pending loads, keep finished ones in the render cache"""
+        self._stand_in_drop()
+        self._renders_stop()
+
+    def _renders_stop(self):
+        self.rendering = False
+        self.tiles_clear()
+        for name in "pv_img", "hq_img":
+            if self.render_cache is not None and name in self.loaded:
+                self._cache_put(name)
+            else:
+                img = getattr(self, name)
+                self.renderer.cancel(img)
+                img.image_data_set(None)
+                img.hide()
+        self.loaded.clear()
 
-        self.hq_img.on_image_preloaded_add(self.hq_preloaded, self.pv_img)
+    def unbind(self):
+        """Drop the rendered page, the object is about to be recycled"""
+        if self.in_viewport:
+            self.viewport_leave()
+        else:
+            self.render_stop()
 
-        self.size_hint_min = w, h
+    def page_set(self, page_num, w, h, zoom):
+        """Rebind a recycled page object to another page"""
+        self.unbind()
+        self.page_num = page_num
+        if self._page_num_label is not None:
+            self._page_num_label.text = str(page_num + 1)
+        self.orig_w = float(w)
+        self.orig_h = float(h)
+        self.zoom_set(zoom)
 
-        self.pass_events = True
+    def size_set(self, w, h):
+        """Change the page size, it was an estimate"""
+        self.orig_w = float(w)
+        self.orig_h = float(h)
+        self.zoom_set(self.zoom)
 
     def zoom_set(self, value):
-        old_size = self.size_hint_min
-        new_size = [(i * value) for i in (self.orig_w, self.orig_h)]
-        if (
-                (old_size[0] >= self.SIZE_MIN or
-                 old_size[1] >= self.SIZE_MIN) and
-                (new_size[0] < self.SIZE_MIN or
-                 new_size[1] < self.SIZE_MIN)):
-            return
+        """Set the render sizes for a zoom level
+
+        A page being rendered starts over at the new size, showing its
+        current rendering scaled until the new one is ready. Other pages
+        only get the new sizes.
+        """
+        rendering = self.rendering
+        if rendering:
+            self._stand_in_keep()
+        self._renders_stop()
+
+        self.zoom = value
+        self.tiled = value >= self.TILE_ZOOM
+        # the tiles cover the page when tiled, the preview is only their
+        # backdrop and does not grow with the zoom
+        pv_zoom = min(value, self.TILE_ZOOM) / 2
         self.pv_img.load_size = [
-            (i * value / 2) for i in (self.orig_w, self.orig_h)
+            (i * pv_zoom) for i in (self.orig_w, self.orig_h)
             ]
         self.hq_img.load_size = [
             (i * value * 2) for i in (self.orig_w, self.orig_h)
             ]
-        self.size_hint_min = new_size
 
-    def hq_preloaded(self, hq_img, pv_img):
+        if rendering:
+            self.render_start()
+
+    def tiles_update(self, x, y, w, h):
+        """Keep rendered only the tiles intersecting the given rectangle
+
+        The rectangle is in page coordinates at the current zoom.
+        """
+        ts = self.TILE_SIZE
+        pw, ph = self.size
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + w, pw), min(y + h, ph)
+        wanted = set()
+        if x2 > x1 and y2 > y1:
+            for ty in range(int(y1 // ts), int((y2 - 1) // ts) + 1):
+                for tx in range(int(x1 // ts), int((x2 - 1) // ts) + 1):
+                    wanted.add((tx, ty))
+
+        for key in list(self.tiles):
+            if key not in wanted:
+                img = self.tiles.pop(key)
+                self.renderer.cancel(img)
+                img.delete()
+
+        for key in wanted:
+            if key not in self.tiles:
+                self.tiles[key] = self._tile_add(*key)
+
+    def _tile_add(self, tx, ty):
+        ts = self.TILE_SIZE
+        pw, ph = self.size
+        rx, ry = tx * ts, ty * ts
+        rw, rh = min(ts, pw - rx), min(ts, ph - ry)
+        img = FilledImage(self.evas, load_dpi=1, load_size=(pw, ph))
+        img.load_region = rx, ry, rw, rh
+        self.member_add(img)
+        clip = self.clip
+        if clip is not None:
+            img.clip = clip
+        x, y = self.pos
+        img.geometry = x + rx, y + ry, rw, rh
+        self.renderer.render(
+            img, self.doc_path, self.page_num, self.tile_preloaded)
+        log.debug("preloading tile %d %d,%d", self.page_num, tx, ty)
+        return img
+
+    def tiles_position(self, x, y, w, h):
+        """Place the tiles on the page at x, y shown at size w x h
+
+        While the page is shown at another size than it was rendered at,
+        during a zoom, the tiles are scaled along with the preview.
+        """
+        rw, rh = self.orig_w * self.zoom, self.orig_h * self.zoom
+        if not self.tiles or rw <= 0 or rh <= 0:
+            return
+        sx, sy = w / rw, h / rh
+        for img in self.tiles.values():
+            tx, ty, tw, th = img.load_region
+            # edges rounded on their own, scaled tiles leave no gaps
+            x1, y1 = int(round(x + tx * sx)), int(round(y + ty * sy))
+            x2 = int(round(x + (tx + tw) * sx))
+            y2 = int(round(y + (ty + th) * sy))
+            img.geometry = x1, y1, x2 - x1, y2 - y1
+
+    def tiles_clear(self):
+        for img in self.tiles.values():
+            self.renderer.cancel(img)
+            img.delete()
+        self.tiles.clear()
+
+    @staticmethod
+    def tile_preloaded(img):
+        img.show()
+
+    def hq_preloaded(self, hq_img):
         log.debug("preloaded hq %d", self.page_num)
-        pv_img.hide()
+        self.loaded.add("hq_img")
+        self._stand_in_drop()
+        self.pv_img.hide()
         hq_img.show()
 
     def pv_preloaded(self, pv_img):
         log.debug("preloaded pv %d", self.page_num)
+        self.loaded.add("pv_img")
         pv_img.show()
-        for img in (self.hq_img,):
-            img.file = (self.doc_path, str(self.page_num))
-            img.preload()
+        if self.preview_cache is not None and not self.pv_from_disk:
+            page_num = self.page_num
+            self.preview_cache.store(
+                pv_img, self.fingerprint, page_num,
+                lambda: (
+                    self.pv_img is pv_img and self.page_num == page_num and
+                    "pv_img" in self.loaded))
+        if self.tiled:
+            self._stand_in_drop()
+        else:
+            self._hq_start()
+
+    def _hq_start(self):
+        self.renderer.render(
+            self.hq_img, self.doc_path, self.page_num, self.hq_preloaded)
         log.debug("preloading hq %d", self.page_num)
 
 
@@ -841,15 +1597,11 @@ class PasswordPrompt(Popup):
         self.show()
 
     def okcb(self):
-        ret = 0
-        try:
-            ret = self.parent.doc.decrypt(self.e.entry.encode("utf-8"))
-        except Exception:
-            log.exception("Could not decrypt the document")
-            return
-        if ret:
-            self.parent.metadata_read()
-            self.parent.populate_pages()
+        self.parent.shared.decrypt(
+            self.e.entry.encode("utf-8"), self.decrypted)
+
+    def decrypted(self, ok):
+        if ok:
             self.delete()
         else:
             self.part_text_set("title,text", "Document is encrypted - Invalid password entered")
@@ -860,6 +1612,18 @@ if __name__ == "__main__":
     parser.add_argument(
         'documents', metavar='pdf', type=str, nargs='*',
         help='documents you may want to display')
+    parser.add_argument(
+        '--render-cache', metavar='MB', type=float, default=64,
+        help='memory kept for rendered pages that left the view')
+    parser.add_argument(
+        '--prefetch', metavar='N', type=int, default=3,
+        help='pages rendered ahead of the scrolling direction')
+    parser.add_argument(
+        '--renderer', choices=('evas', 'process'), default='evas',
+        help='render pages in the evas loader or in worker processes')
+    parser.add_argument(
+        '--parser', choices=('thread', 'process'), default='thread',
+        help='read documents in a thread or in helper processes')
     args = parser.parse_args()
 
     handler = logging.StreamHandler()
@@ -878,24 +1642,12 @@ if __name__ == "__main__":
 
     elm.policy_set(ELM_POLICY_QUIT, ELM_POLICY_QUIT_LAST_WINDOW_CLOSED)
 
-    doc_specs = {}
-
-    cfg_base_path = BaseDirectory.save_config_path("lekha")
-    cfg_file_path = os.path.join(cfg_base_path, "document_positions")
-
-    if not os.path.exists(cfg_file_path):
-        try:
-            open(cfg_file_path, "w").close()
-        except Exception as e:
-            log.debug(e)
-
-    with open(cfg_file_path, "r") as fp:
-        try:
-            doc_specs = json.load(fp)
-        except Exception:
-            log.info("document positions could not be restored")
-
-    app = AppWindow(doc_specs)
+    app = AppWindow({
+        "render_cache_mb": args.render_cache,
+        "prefetch_pages": args.prefetch,
+        "renderer": args.renderer,
+        "parser": args.parser,
+        })
 
     docs = []
 
@@ -906,14 +1658,7 @@ if __name__ == "__main__":
 
     elm.run()
 
-    for d in app.docs:
-        path = d.doc_path
-        zoom = d.zoom
-        pos = d.doc_pos
-        doc_specs[path] = (zoom, pos)
-
-    with open(cfg_file_path, "w") as fp:
-        json.dump(doc_specs, fp, indent=4, separators=(',', ': '))
+    log.info("render cache: %r", app.render_cache.stats())
 
     elm.shutdown()
     evas.shutdown()
@@ -0,0 +1,372 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Headless benchmarks of opening, laying out and navigating documents
+
+Synthetic documents are generated with PyPDF2 and opened in a real
+AppWindow on the elementary buffer engine, so no display is needed. The
+steps that complete in the background (opening, first rendered page, full
+layout) are timed by polling from an ecore timer, the rest are timed
+directly. Results are written as JSON.
+
+The caches and the position store are kept in a temporary directory, so
+every run starts cold. With LEKHA_PROFILE set, a trace of the main loop
+is written as well, see lekha.instrument.
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+
+from .instrument import clock
+from .util import write_atomic
+
+log = logging.getLogger("lekha")
+
+#: Page sizes cycled through in the generated documents
+PAGE_SIZES = (612, 792), (595, 842), (842, 595), (420, 595), (612, 1008)
+#: Page counts of the default documents
+PAGE_COUNTS = 10, 1000, 10000
+#: Levels of nested outline entries below each chapter
+OUTLINE_DEPTH = 4
+
+
+def make_pdf(path, pages, depth=OUTLINE_DEPTH):
+    """Write a document of blank pages of mixed sizes and deep outlines
+
+    Every 100 pages, or every page of shorter documents, start a chapter
+    with nested sections two per level, depth levels deep.
+    """
+    import PyPDF2
+
+    writer = PyPDF2.PdfFileWriter()
+    for pg_num in range(pages):
+        writer.addBlankPage(*PAGE_SIZES[pg_num % len(PAGE_SIZES)])
+
+    chapter_len = 100 if pages >= 100 else 1
+
+    def sections_add(parent, title, first, count, level):
+        if level > depth or count < 1:
+            return
+        half = max(count // 2, 1)
+        for i, start in enumerate((first, first + half)):
+            if start >= first + count:
+                break
+            name = "%s.%d" % (title, i + 1)
+            item = writer.addBookmark(name, start, parent)
+            sections_add(item, name, start, half, level + 1)
+
+    for n, first in enumerate(range(0, pages, chapter_len)):
+        title = "Chapter %d" % (n + 1)
+        item = writer.addBookmark(title, first)
+        sections_add(
+            item, title, first, min(chapter_len, pages - first), 1)
+
+    buf = io.BytesIO()
+    writer.write(buf)
+    write_atomic(path, buf.getvalue())
+
+
+def fixture(base_path, pages):
+    """Path of a generated document of the given length, made if missing"""
+    path = os.path.join(base_path, "bench-%d.pdf" % pages)
+    if not os.path.exists(path):
+        t1 = clock()
+        make_pdf(path, pages)
+        log.info("Generating %s took: %f", path, clock() - t1)
+    return path
+
+
+def stats(samples):
+    """Summary of a list of durations in seconds"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "median": ordered[len(ordered) // 2],
+        "max": ordered[-1],
+        }
+
+
+class Run(object):
+
+    """Opens one document in the main loop and measures it
+
+    done_cb(results) is called when all the steps have finished.
+    """
+
+    #: Seconds between checks of the background steps
+    POLL = 0.001
+    #: Seconds to wait for a background step before giving up on it
+    STEP_TIMEOUT = 120.0
+
+    SCROLL_STEPS = 200
+    ZOOMS = 0.5, 0.75, 1.0, 1.5, 2.5, 1.0
+    LOOKUPS = 1000
+    JUMPS = 50
+
+    def __init__(self, app, path, done_cb):
+        self.app = app
+        self.path = path
+        self.done_cb = done_cb
+        self.doc = None
+        self.results = {"document": os.path.basename(path)}
+        self._steps = None
+        self._wait = None
+        self._wait_start = None
+
+    def start(self):
+        from efl.ecore import Timer
+
+        self._steps = self.steps()
+        self._wait = next(self._steps)
+        self._wait_start = clock()
+        Timer(self.POLL, self._poll)
+
+    def _poll(self):
+        try:
+            while True:
+                now = clock()
+                if self._wait():
+                    self._wait = self._steps.send(now)
+                elif now - self._wait_start > self.STEP_TIMEOUT:
+                    log.error("benchmark step timed out")
+                    self._wait = self._steps.send(None)
+                else:
+                    return True
+                self._wait_start = clock()
+        except StopIteration:
+            self.done_cb(self.results)
+            return False
+
+    def _elapsed(self, key, t0, now):
+        self.results[key] = None if now is None else now - t0
+
+    def steps(self):
+        """Generator of the conditions to wait for between the steps"""
+        from .registry import OPENED
+
+        r = self.results
+
+        t0 = clock()
+        self.app.document_open(self.path)
+        doc = self.doc = self.app.docs[-1]
+        shared = doc.shared
+
+        now = yield lambda: shared.state == OPENED
+        self._elapsed("open_s", t0, now)
+        r["pages"] = shared.page_count
+
+        def first_rendered():
+            for pg_num in doc.visible_pages:
+                page = doc.page_layout.realized.get(pg_num)
+                if page is not None and page.loaded:
+                    return True
+            return False
+
+        now = yield first_rendered
+        self._elapsed("first_page_s", t0, now)
+
+        now = yield lambda: (
+            not shared.table.unknown and shared.outlines is not None)
+        self._elapsed("full_layout_s", t0, now)
+
+        r["zoom_s"] = self.zoom_cost()
+        r["scroll_step_s"] = self.scroll_cost()
+        r.update(self.navigation_cost())
+        r["memory"] = doc.memory()
+
+        del self.app.tabs[doc]
+
+    def zoom_cost(self):
+        doc = self.doc
+        samples = []
+        for z in self.ZOOMS:
+            t1 = clock()
+            doc.zoom = z
+            doc.page_layout.render_zoom_set(z)
+            doc.viewport_update()
+            samples.append(clock() - t1)
+        return stats(samples)
+
+    def scroll_cost(self):
+        doc = self.doc
+        x, y, w, h = doc.scr.region
+        height = doc.table.height * doc.zoom
+        samples = []
+        for i in range(self.SCROLL_STEPS):
+            y = int((height - h) * i / self.SCROLL_STEPS)
+            t1 = clock()
+            doc.scr.region_show(0, y, w, h)
+            doc.viewport_update()
+            samples.append(clock() - t1)
+        return stats(samples)
+
+    def navigation_cost(self):
+        doc = self.doc
+        table = doc.table
+        rnd = random.Random(0)
+        count = len(table)
+
+        ids = [table.ids[rnd.randrange(count)] for i in range(self.LOOKUPS)]
+        t1 = clock()
+        for page_id in ids:
+            table.page_num(page_id)
+        lookup = (clock() - t1) / len(ids)
+
+        samples = []
+        for i in range(self.JUMPS):
+            pg_num = rnd.randrange(count)
+            t1 = clock()
+            doc.page_show_by_num(pg_num)
+            doc.viewport_update()
+            samples.append(clock() - t1)
+
+        return {"id_lookup_s": lookup, "page_jump_s": stats(samples)}
+
+
+def run(paths, settings=None):
+    """Measure the documents one after another, return the results"""
+    import efl.elementary as elm
+    import efl.evas as evas
+    from efl.elementary import ELM_POLICY_QUIT, \
+        ELM_POLICY_QUIT_LAST_WINDOW_CLOSED
+
+    from .app import AppWindow
+    from . import instrument
+
+    evas.init()
+    elm.init()
+    elm.policy_set(ELM_POLICY_QUIT, ELM_POLICY_QUIT_LAST_WINDOW_CLOSED)
+
+    app = AppWindow(settings)
+    app.resize(800, 600)
+    app.show()
+
+    results = []
+    queue = list(paths)
+
+    def next_run(result=None):
+        if result is not None:
+            log.info("%r", result)
+            results.append(result)
+        if not queue:
+            elm.exit()
+            return
+        Run(app, queue.pop(0), next_run).start()
+
+    next_run()
+    elm.run()
+    instrument.dump()
+
+    app.renderer.shutdown()
+    if app.parser is not None:
+        app.parser.shutdown()
+    app.positions.close()
+    app.delete()
+    elm.shutdown()
+    evas.shutdown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark opening and navigating documents")
+    parser.add_argument(
+        'documents', metavar='pdf', type=str, nargs='*',
+        help='documents to measure instead of the generated ones')
+    parser.add_argument(
+        '--pages', metavar='N', type=int, nargs='+', default=PAGE_COUNTS,
+        help='page counts of the generated documents')
+    parser.add_argument(
+        '--fixtures', metavar='DIR',
+        help='directory keeping the generated documents between runs')
+    parser.add_argument(
+        '--renderer', choices=('evas', 'process'), default='evas',
+        help='render pages in the evas loader or in worker processes')
+    parser.add_argument(
+        '--parser', choices=('thread', 'process'), default='thread',
+        help='read documents in a thread or in helper processes')
+    parser.add_argument(
+        '-o', '--output', metavar='FILE',
+        help='write the results here instead of the standard output')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(name)s [%(levelname)s] %(module)s:%(lineno)d   %(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO if args.verbose else logging.WARN)
+
+    # Keep the user's caches and positions out of it, start every run cold
+    scratch = tempfile.mkdtemp(prefix="lekha-bench-")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(scratch, "cache")
+    os.environ["XDG_CONFIG_HOME"] = os.path.join(scratch, "config")
+    os.environ.setdefault("ELM_ENGINE", "buffer")
+
+    try:
+        paths = [os.path.abspath(p) for p in args.documents]
+        if not paths:
+            base_path = args.fixtures or scratch
+            if not os.path.isdir(base_path):
+                os.makedirs(base_path)
+            paths = [fixture(base_path, n) for n in args.pages]
+
+        results = run(paths, {
+            "renderer": args.renderer,
+            "parser": args.parser,
+            })
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine": os.environ["ELM_ENGINE"],
+        "renderer": args.renderer,
+        "parser": args.parser,
+        "results": results,
+        }
+    data = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(data + "\n")
+    else:
+        print(data)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict, deque
+
+from efl.ecore import Idler
+from xdg import BaseDirectory
+
+from . import jobs
+from . import render
+from . import instrument
+from .util import write_atomic
+
+log = logging.getLogger("lekha")
+
+
+def document_fingerprint(path):
+    """Identify the contents of a document file by path, size and mtime"""
+    st = os.stat(path)
+    key = "%s\0%d\0%d" % (
+        os.path.realpath(path), st.st_size, int(st.st_mtime * 1000))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class GeometryCache(object):
+
+    """On-disk cache of page counts, page sizes, page ids and outline
+    destinations
+
+    Entries are keyed by the document fingerprint, so a modified file
+    misses the cache instead of getting a stale layout. The destination
+    table maps outline entry keys to (page number, fit type, arguments),
+    see parser.destination_table(). It is missing from an entry until it
+    has been built.
+    """
+
+    VERSION = 1
+
+    def __init__(self, base_path=None):
+        if base_path is None:
+            base_path = BaseDirectory.save_cache_path("lekha", "geometry")
+        self.base_path = base_path
+
+    def _path(self, fingerprint):
+        return os.path.join(self.base_path, fingerprint + ".json")
+
+    def load(self, fingerprint):
+        try:
+            with open(self._path(fingerprint), "rb") as fp:
+                entry = json.loads(fp.read().decode("utf-8"))
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            log.info("page geometry cache entry %s is corrupt", fingerprint)
+            return None
+        if entry.get("version") != self.VERSION:
+            return None
+        if len(entry["sizes"]) != entry["page_count"]:
+            return None
+        if "destinations" in entry:
+            entry["destinations"] = dict(
+                (key, (pg_num, typ, tuple(args)))
+                for key, pg_num, typ, args in entry["destinations"])
+        return entry
+
+    def save(self, fingerprint, sizes, ids, destinations=None):
+        sizes = [[float(w), float(h)] for w, h in sizes]
+        entry = {
+            "version": self.VERSION,
+            "page_count": len(sizes),
+            "sizes": sizes,
+            "ids": [int(i) for i in ids],
+            }
+        if destinations is not None:
+            entry["destinations"] = [
+                [key, pg_num, typ, list(args)]
+                for key, (pg_num, typ, args) in destinations.items()]
+        try:
+            write_atomic(
+                self._path(fingerprint), json.dumps(entry).encode("utf-8"))
+        except (IOError, OSError) as e:
+            log.info("page geometry could not be cached: %r", e)
+
+
+class RenderCache(object):
+
+    """Rendered page images kept in memory within a byte budget
+
+    Keys are (document, page number, render width, render height). An
+    entry is handed out at most once, ``take`` removes it from the cache.
+    When the budget is exceeded the least recently stored entries are
+    passed to ``evict_cb`` and forgotten.
+    """
+
+    def __init__(self, budget_mb, evict_cb=None):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.evict_cb = evict_cb
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def put(self, key, value, nbytes):
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = value, nbytes
+        self.used += nbytes
+        while self.used > self.budget and self._entries:
+            self._evict(next(iter(self._entries)))
+
+    def take(self, key):
+        try:
+            value, nbytes = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.used -= nbytes
+        self.hits += 1
+        return value
+
+    def _evict(self, key):
+        value, nbytes = self._entries.pop(key)
+        self.used -= nbytes
+        if self.evict_cb is not None:
+            self.evict_cb(value)
+
+    def drop(self, match):
+        """Evict the entries whose key match(key) is true for"""
+        for key in [k for k in self._entries if match(k)]:
+            self._evict(key)
+
+    def usage(self, match):
+        """Number and bytes of the entries whose key match(key) is true for"""
+        count = nbytes = 0
+        for key, (value, size) in self._entries.items():
+            if match(key):
+                count += 1
+                nbytes += size
+        return {"entries": count, "bytes": nbytes}
+
+    def clear(self):
+        while self._entries:
+            self._evict(next(iter(self._entries)))
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.used,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            }
+
+
+class PreviewCache(object):
+
+    """On-disk store of page preview images
+
+    Previews are keyed by document fingerprint, page number and preview
+    size and saved as JPEG files. An idler copies the pixels of one
+    preview per main loop iteration, they are encoded and written in a
+    worker process. When the files exceed the budget the least recently
+    used ones are removed in a background job.
+    """
+
+    SAVE_FLAGS = "quality=85"
+
+    def __init__(self, budget_mb, base_path=None):
+        if base_path is None:
+            base_path = BaseDirectory.save_cache_path("lekha", "previews")
+        self.base_path = base_path
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.used = 0
+        self._evicting = False
+        self._pending = deque()
+        self._idler = None
+        self._pool = None
+        self._jobs = set()
+
+        self._evict_start()
+
+    def path(self, fingerprint, page_num, w, h):
+        return os.path.join(
+            self.base_path, "%s-%d-%dx%d.jpg" % (fingerprint, page_num, w, h))
+
+    def lookup(self, fingerprint, page_num, w, h):
+        path = self.path(fingerprint, page_num, w, h)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def store(self, img, fingerprint, page_num, valid_cb):
+        """Queue a loaded preview image for saving
+
+        valid_cb is called before saving and must return True if img still
+        holds the preview of page_num.
+        """
+        w, h = img.load_size
+        path = self.path(fingerprint, page_num, w, h)
+        self._pending.append((img, path, valid_cb))
+        if self._idler is None:
+            self._idler = Idler(instrument.timed(self._save_next, "idler"))
+
+    def _save_next(self):
+        if not self._pending:
+            self._idler = None
+            return False
+        img, path, valid_cb = self._pending.popleft()
+        if not valid_cb() or os.path.exists(path):
+            return True
+        try:
+            w, h, data = render.image_pixels(img)
+        except Exception as e:
+            log.info("preview could not be cached: %r", e)
+            return True
+        if self._pool is None:
+            self._pool = render.worker_pool(1)
+        job = jobs.runner().submit(
+            self._pool, render.encode_image, path, w, h, data,
+            self.SAVE_FLAGS,
+            done_cb=lambda size: self._saved(job, size),
+            error_cb=lambda e: self._save_error(job, e))
+        self._jobs.add(job)
+        return True
+
+    def _saved(self, job, size):
+        self._jobs.discard(job)
+        self.used += size
+        if self.used > self.budget:
+            self._evict_start()
+
+    def _save_error(self, job, e):
+        self._jobs.discard(job)
+        log.info("preview could not be cached: %r", e)
+
+    def cancel(self):
+        self._pending.clear()
+        if self._idler is not None:
+            self._idler.delete()
+            self._idler = None
+        for job in self._jobs:
+            job.cancel()
+        self._jobs.clear()
+
+    def shutdown(self):
+        self.cancel()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _evict_start(self):
+        if self._evicting:
+            return
+        self._evicting = True
+        jobs.runner().run(
+            self._evict, self.base_path, self.budget,
+            done_cb=self._evict_done, error_cb=self._evict_error)
+
+    def _evict_done(self, used):
+        self._evicting = False
+        self.used = used
+
+    def _evict_error(self, e):
+        self._evicting = False
+        log.info("preview cache could not be trimmed: %r", e)
+
+    @staticmethod
+    def _evict(base_path, budget):
+        entries = []
+        for name in os.listdir(base_path):
+            if not name.endswith(".jpg") or ".tmp." in name:
+                continue
+            path = os.path.join(base_path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        used = sum(e[1] for e in entries)
+        if used > budget:
+            target = budget * 0.9
+            for mtime, size, path in sorted(entries):
+                if used <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                used -= size
+        return used
@@ -0,0 +1,263 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Opt-in timing of the main loop callbacks
+
+Enabled by setting LEKHA_PROFILE to the path of a trace file, or with
+``bin/lekha --profile FILE``, before lekha.app is imported. The idler
+iterations and idle tasks, timers, smart object and image callbacks and
+background jobs are timed, with a latency histogram per call site.
+Callbacks taking longer than a frame are logged as they happen.
+
+The trace is written in the Chrome trace event format, loadable in
+chrome://tracing, Perfetto and speedscope. Background jobs overlap, they
+are async events of their own, from submission to their result reaching
+the main loop.
+
+When disabled, timed() returns the callbacks as they are and nothing is
+measured.
+"""
+
+import os
+import json
+import time
+import logging
+import functools
+from bisect import bisect_left
+
+from .util import write_atomic
+
+log = logging.getLogger("lekha")
+
+clock = getattr(time, "perf_counter", time.time)
+
+#: Environment variable naming the trace file
+ENV = "LEKHA_PROFILE"
+#: Seconds a main loop callback may take without dropping a frame
+FRAME_BUDGET = 1.0 / 60
+#: Upper bounds of the histogram buckets in milliseconds, the last bucket
+#: takes the rest
+BUCKETS = 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256
+BUCKET_LABELS = ["<=%g" % b for b in BUCKETS] + [">%g" % BUCKETS[-1]]
+#: Trace events kept, the histograms go on counting after this
+MAX_EVENTS = 1000000
+
+#: Trace thread ids
+MAIN = 0
+JOBS = 1
+
+#: Methods of evas Smart classes evas calls
+SMART_METHODS = (
+    "delete", "member_add", "member_del", "move", "resize", "show", "hide",
+    "color_set", "clip_set", "clip_unset", "calculate")
+
+
+class Site(object):
+
+    """Latency statistics of one call site"""
+
+    __slots__ = "count", "total", "longest", "overruns", "histogram"
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.overruns = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration, over):
+        self.count += 1
+        self.total += duration
+        if duration > self.longest:
+            self.longest = duration
+        if over:
+            self.overruns += 1
+        self.histogram[bisect_left(BUCKETS, duration * 1000.0)] += 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000.0,
+            "max_ms": self.longest * 1000.0,
+            "overruns": self.overruns,
+            "histogram_ms": dict(
+                (label, n)
+                for label, n in zip(BUCKET_LABELS, self.histogram) if n),
+            }
+
+
+class Profiler(object):
+
+    def __init__(self, path, budget=FRAME_BUDGET):
+        self.path = path
+        self.budget = budget
+        self.start = clock()
+        self.events = []
+        self.dropped = 0
+        self.sites = {}
+
+    def record(self, name, cat, start, duration, tid=MAIN, async_id=None):
+        """Add a measured call, start and duration in seconds
+
+        Calls with an async_id may overlap others of the same thread,
+        like background jobs, they are traced as async events.
+        """
+        over = tid == MAIN and duration > self.budget
+        key = cat, name
+        site = self.sites.get(key)
+        if site is None:
+            site = self.sites[key] = Site()
+        site.add(duration, over)
+        if over:
+            log.warn(
+                "%s %s took %.1f ms, over the %.1f ms frame budget",
+                cat, name, duration * 1000.0, self.budget * 1000.0)
+        if len(self.events) < MAX_EVENTS:
+            self.events.append(
+                (name, cat, start, duration, tid, over, async_id))
+        else:
+            self.dropped += 1
+
+    def summary(self):
+        """Statistics of every call site, keyed by "category name" """
+        return dict(
+            ("%s %s" % key, site.summary())
+            for key, site in self.sites.items())
+
+    def trace(self):
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": MAIN,
+             "args": {"name": "main loop"}},
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": JOBS,
+             "args": {"name": "background jobs"}},
+            ]
+        for name, cat, start, duration, tid, over, async_id in self.events:
+            ts = (start - self.start) * 1e6
+            if async_id is not None:
+                # async begin and end events pair by id, not by nesting
+                for ph, t in ("b", ts), ("e", ts + duration * 1e6):
+                    events.append({
+                        "name": name, "cat": cat, "ph": ph, "pid": pid,
+                        "tid": tid, "ts": t, "id": async_id,
+                        })
+                continue
+            event = {
+                "name": name, "cat": cat, "ph": "X", "pid": pid, "tid": tid,
+                "ts": ts, "dur": duration * 1e6,
+                }
+            if over:
+                event["args"] = {"over_budget": True}
+            events.append(event)
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "frame_budget_ms": "%g" % (self.budget * 1000.0),
+                "dropped_events": "%d" % self.dropped,
+                },
+            "lekhaSites": self.summary(),
+            }
+
+    def dump(self, path=None):
+        """Write the trace file"""
+        path = path or self.path
+        write_atomic(path, json.dumps(self.trace()).encode("utf-8"))
+
+        slowest = sorted(
+            self.sites.items(), key=lambda item: -item[1].total)[:10]
+        for (cat, name), site in slowest:
+            log.warn(
+                "%s %s: %d calls, %.1f ms total, %.2f ms max, %d overruns",
+                cat, name, site.count, site.total * 1000.0,
+                site.longest * 1000.0, site.overruns)
+        log.warn("Profile trace written to %s", path)
+
+
+_profiler = None
+
+
+def enable(path, budget=FRAME_BUDGET):
+    global _profiler
+    _profiler = Profiler(path, budget)
+    return _profiler
+
+
+def profiler():
+    """The active Profiler, or None"""
+    return _profiler
+
+
+def _site_name(func):
+    name = getattr(func, "__name__", None) or repr(func)
+    owner = getattr(func, "__self__", None)
+    if owner is not None:
+        return "%s.%s" % (owner.__class__.__name__, name)
+    return name
+
+
+def timed(func, cat, name=None):
+    """func timed as a call of category cat when profiling"""
+    if _profiler is None:
+        return func
+    if name is None:
+        name = _site_name(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        t1 = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _profiler.record(name, cat, t1, clock() - t1)
+
+    return wrapper
+
+
+def smart(cls):
+    """Class decorator timing the methods of an evas Smart class"""
+    if _profiler is None:
+        return cls
+    for attr in SMART_METHODS:
+        method = cls.__dict__.get(attr)
+        if method is None:
+            continue
+        name = "%s.%s" % (cls.__name__, attr)
+        if isinstance(method, staticmethod):
+            setattr(cls, attr, staticmethod(
+                timed(method.__func__, "smart", name)))
+        else:
+            setattr(cls, attr, timed(method, "smart", name))
+    return cls
+
+
+def job_done(name, start, job_id):
+    """Record a background job submitted at start as done now"""
+    if _profiler is not None:
+        _profiler.record(name, "job", start, clock() - start, JOBS, job_id)
+
+
+def dump():
+    if _profiler is not None:
+        _profiler.dump()
+
+
+if os.environ.get(ENV):
+    enable(os.environ[ENV])
@@ -0,0 +1,228 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Handing documents over to an already running instance
+
+The first instance listens on a Unix domain socket in the user's runtime
+directory, or without one in a private directory in the temporary
+directory. Sockets not owned by the user are left alone. Later
+instances send it their documents as one JSON line, wait for its reply
+and exit. The client side only uses the standard library so it can run
+before the EFL modules are imported.
+"""
+
+import os
+import json
+import stat
+import errno
+import socket
+import logging
+import tempfile
+
+log = logging.getLogger("lekha")
+
+
+def _private_dir(path):
+    """Make path a directory only the user can use, True if it is one"""
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return False
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+        not st.st_mode & 0o077)
+
+
+def _owned(path):
+    """True if path is a socket of the user, not a link to one"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def socket_path():
+    """Path of the single instance socket, None without a safe place"""
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if not base or not os.path.isdir(base):
+        # other users can create files in the temporary directory, the
+        # socket goes in a directory of our own so it cannot be planted
+        base = os.path.join(tempfile.gettempdir(), "lekha-%d" % os.getuid())
+        if not _private_dir(base):
+            log.warn("%s is not a private directory, no single instance", base)
+            return None
+    return os.path.join(base, "lekha-%d.sock" % os.getuid())
+
+
+def _connect(path, timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def send(documents, timeout=2.0):
+    """Pass documents to a running instance, True if one took them"""
+    paths = []
+    for doc_path in documents:
+        if not doc_path.startswith("file://"):
+            doc_path = os.path.abspath(doc_path)
+        paths.append(doc_path)
+
+    path = socket_path()
+    if path is None or not _owned(path):
+        return False
+    sock = _connect(path, timeout)
+    if sock is None:
+        return False
+    try:
+        msg = json.dumps({"documents": paths}) + "\n"
+        sock.sendall(msg.encode("utf-8"))
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = sock.recv(64)
+            if not data:
+                break
+            reply += data
+    except socket.error as e:
+        log.info("running instance did not respond: %r", e)
+        return False
+    finally:
+        sock.close()
+    return reply == b"ok\n"
+
+
+class Server(object):
+
+    """Receives documents from later instances in the ecore main loop
+
+    open_cb(documents) is called with the list of document paths of
+    each client.
+    """
+
+    def __init__(self, open_cb):
+        self.open_cb = open_cb
+        self.path = socket_path()
+        self.sock = None
+        self._handler = None
+        self._clients = {}
+
+    def listen(self):
+        """Start listening, False if another instance already does"""
+        from efl.ecore import FdHandler, ECORE_FD_READ
+
+        if self.path is None:
+            return False
+        if os.path.lexists(self.path) and not _owned(self.path):
+            log.warn("%s is not our socket, not replacing it", self.path)
+            return False
+        sock = _connect(self.path, 0.5)
+        if sock is not None:
+            sock.close()
+            return False
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.info("stale socket could not be removed: %r", e)
+                return False
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+            sock.listen(8)
+        except socket.error as e:
+            log.info("single instance socket could not be set up: %r", e)
+            sock.close()
+            return False
+        sock.setblocking(False)
+        self.sock = sock
+        self._handler = FdHandler(
+            sock.fileno(), ECORE_FD_READ, self._accept)
+        return True
+
+    def _accept(self, fdh):
+        from efl.ecore import FdHandler, ECORE_FD_READ
+
+        try:
+            conn, addr = self.sock.accept()
+        except socket.error:
+            return True
+        conn.setblocking(False)
+        handler = FdHandler(conn.fileno(), ECORE_FD_READ, self._read, conn)
+        self._clients[conn] = [handler, b""]
+        return True
+
+    def _read(self, fdh, conn):
+        client = self._clients[conn]
+        try:
+            data = conn.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            data = b""
+        client[1] += data
+        if data and not data.endswith(b"\n"):
+            return True
+
+        # returning False deletes the handler
+        del self._clients[conn]
+        try:
+            msg = json.loads(client[1].decode("utf-8"))
+            documents = msg["documents"]
+        except (ValueError, KeyError, TypeError) as e:
+            log.info("invalid message from a new instance: %r", e)
+            conn.close()
+            return False
+        try:
+            conn.sendall(b"ok\n")
+        except socket.error:
+            pass
+        conn.close()
+        self.open_cb(documents)
+        return False
+
+    def _close(self, conn):
+        handler = self._clients.pop(conn)[0]
+        handler.delete()
+        conn.close()
+
+    def close(self):
+        for conn in list(self._clients):
+            self._close(conn)
+        if self.sock is not None:
+            self._handler.delete()
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,186 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Background jobs reporting back to the ecore main loop
+
+Jobs run in a thread of their own or in a multiprocessing pool. When one
+finishes its result is queued and a byte is written to a pipe watched by
+an ecore fd handler, so the done callback runs in the main loop as soon
+as the main loop gets to it, without any polling.
+"""
+
+import os
+import sys
+import logging
+import itertools
+from collections import deque
+from threading import Thread
+
+from efl.ecore import FdHandler, ECORE_FD_READ
+
+from . import instrument
+from .util import call
+
+log = logging.getLogger("lekha")
+
+
+class Job(object):
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name, done_cb=None, error_cb=None):
+        self.id = next(self._ids)
+        self.name = name
+        if done_cb is not None:
+            done_cb = instrument.timed(done_cb, "job callback", name)
+        self.done_cb = done_cb
+        self.error_cb = error_cb
+        self.started = instrument.clock()
+        self.cancelled = False
+        self.group = None
+
+    def __repr__(self):
+        return "<%s(%r%s)>" % (
+            self.__class__.__name__, self.name,
+            ", cancelled" if self.cancelled else "")
+
+    def cancel(self):
+        """Drop the job, its callbacks will not be called
+
+        A job that already started keeps running to the end, its result
+        is discarded.
+        """
+        self.cancelled = True
+        if self.group is not None:
+            self.group.jobs.discard(self)
+            self.group = None
+
+
+class JobRunner(object):
+
+    def __init__(self):
+        self._results = deque()
+        self._rfd, self._wfd = os.pipe()
+        self._handler = FdHandler(
+            self._rfd, ECORE_FD_READ, instrument.timed(self._dispatch, "fd"))
+
+    def run(self, func, *args, **kwargs):
+        """Run func(*args) in a thread
+
+        Keyword arguments done_cb(result) and error_cb(exception) are
+        called in the main loop, the rest are passed to func.
+        """
+        job = Job(
+            getattr(func, "__name__", repr(func)),
+            kwargs.pop("done_cb", None), kwargs.pop("error_cb", None))
+
+        def worker():
+            self._post(job, call(func, args, kwargs))
+
+        t = Thread(target=worker)
+        t.daemon = True
+        t.start()
+        return job
+
+    def submit(self, pool, func, *args, **kwargs):
+        """Run func(*args) in a multiprocessing pool
+
+        Takes the same callbacks as run(). func, its arguments and its
+        result must be picklable.
+        """
+        job = Job(
+            getattr(func, "__name__", repr(func)),
+            kwargs.pop("done_cb", None), kwargs.pop("error_cb", None))
+        callbacks = {"callback": lambda ret, job=job: self._post(job, ret)}
+        if sys.version_info >= (3,):
+            # errors of the pool itself, like a result that cannot be
+            # pickled, bypass util.call
+            callbacks["error_callback"] = \
+                lambda e, job=job: self._post(job, (None, e, repr(e)))
+        pool.apply_async(call, (func, args, kwargs), **callbacks)
+        return job
+
+    def _post(self, job, ret):
+        self._results.append((job, ret))
+        os.write(self._wfd, b"\0")
+
+    def _dispatch(self, fdh):
+        os.read(self._rfd, 4096)
+        while self._results:
+            job, (result, error, tb) = self._results.popleft()
+            instrument.job_done(job.name, job.started, job.id)
+            if job.cancelled:
+                continue
+            if job.group is not None:
+                job.group.jobs.discard(job)
+                job.group = None
+            # a failing callback must not take the fd handler, and the
+            # results of every other job, down with it
+            try:
+                if error is None:
+                    if job.done_cb is not None:
+                        job.done_cb(result)
+                elif job.error_cb is not None:
+                    job.error_cb(error)
+                else:
+                    log.error("%r failed:\n%s", job, tb)
+            except Exception:
+                log.exception("callback of %r failed", job)
+        return True
+
+    def shutdown(self):
+        self._handler.delete()
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+
+class JobGroup(object):
+
+    """Jobs of one owner, cancelled together when the owner goes away"""
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.jobs = set()
+
+    def _add(self, job):
+        job.group = self
+        self.jobs.add(job)
+        return job
+
+    def run(self, func, *args, **kwargs):
+        return self._add(self.runner.run(func, *args, **kwargs))
+
+    def submit(self, pool, func, *args, **kwargs):
+        return self._add(self.runner.submit(pool, func, *args, **kwargs))
+
+    def cancel(self):
+        for job in list(self.jobs):
+            job.cancel()
+
+
+_runner = None
+
+
+def runner():
+    """The job runner of the main loop"""
+    global _runner
+    if _runner is None:
+        _runner = JobRunner()
+    return _runner
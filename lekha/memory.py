@@ -0,0 +1,106 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Memory accounting of documents
+
+The numbers are computed on request from what the objects hold, nothing
+is tracked as it changes. Decoded images are counted at four bytes per
+pixel, the way evas keeps them. The reader, page table, search index and
+render cache entries of a file are shared by all its tabs and reported
+separately, so they are not counted twice when adding up the tabs.
+"""
+
+import sys
+
+#: Bytes of a decoded image pixel
+BYTES_PER_PIXEL = 4
+#: Resolution levels of the decoded images of a page
+LEVELS = "pv", "hq", "tiles", "stand_in"
+
+MB = 1024.0 * 1024.0
+
+
+def image_bytes(img):
+    """Bytes of the decoded pixels of an evas image"""
+    w, h = img.image_size
+    if w <= 0 or h <= 0:
+        return 0
+    return w * h * BYTES_PER_PIXEL
+
+
+def table_bytes(table):
+    """Bytes of the columns of a PageTable and its page id index"""
+    columns = table.ids, table.widths, table.heights, table._offsets
+    return (
+        sum(c.itemsize * len(c) for c in columns) + len(table.known) +
+        sys.getsizeof(table.index))
+
+
+def reader_usage(doc):
+    """Object caches of a PyPDF2 reader, None without a reader"""
+    if doc is None:
+        return None
+    resolved = getattr(doc, "resolvedObjects", {})
+    stream = getattr(doc, "stream", None)
+    try:
+        mapped = len(stream)
+    except TypeError:
+        mapped = 0
+    return {
+        "resolved_objects": sum(len(objs) for objs in resolved.values()),
+        "page_objects": len(getattr(doc, "flattenedPages", None) or ()),
+        "mapped_bytes": mapped,
+        }
+
+
+def search_usage(index):
+    """Terms and postings of a SearchIndex, None without one"""
+    if index is None:
+        return None
+    return {
+        "terms": len(index.terms),
+        "postings": sum(len(p) for p in index.terms.values()) // 2,
+        "indexed_pages": index.indexed,
+        }
+
+
+def lines(usage):
+    """Short summary lines of the usage of a Document, see Document.memory()"""
+    images = usage["images"]
+    pages = usage["pages"]
+    shared = usage["shared"]
+    text = [
+        "images %.1f MB: " % (sum(images.values()) / MB) + ", ".join(
+            "%s %.1f" % (level, images[level] / MB) for level in LEVELS),
+        "pages %d live, %d recycled" % (pages["realized"], pages["recycled"]),
+        "render cache %.1f MB in %d" % (
+            shared["render_cache"]["bytes"] / MB,
+            shared["render_cache"]["entries"]),
+        "page table %.1f kB" % (shared["page_table"] / 1024.0),
+        ]
+    reader = shared["reader"]
+    if reader is not None:
+        text.append("reader %d objects, %d pages" % (
+            reader["resolved_objects"], reader["page_objects"]))
+    search = shared["search"]
+    if search is not None:
+        text.append("search %d terms, %d postings" % (
+            search["terms"], search["postings"]))
+    return text
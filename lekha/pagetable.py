@@ -0,0 +1,173 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from array import array
+from bisect import bisect_right
+
+
+class PageTable(object):
+
+    """Sizes and vertical positions of the pages of a document
+
+    All values are in PDF units (zoom 1.0), pages are laid out top to
+    bottom without gaps. ``offsets[i]`` is the top edge of page ``i`` and
+    ``offsets[-1]`` and ``height`` the height of the whole document.
+
+    A table can be laid out from an estimated page size first, the real
+    sizes are then set page by page in any order. ``known[i]`` tells if
+    the size of page ``i`` is real. ``index`` maps page ids to page
+    numbers.
+
+    The columns are typed arrays, a page costs some 30 bytes plus its
+    index entry. Page ids are PDF object numbers, 0 stands for a page
+    whose id is not known yet.
+    """
+
+    def __init__(self):
+        self.ids = array("l")
+        self.index = {}
+        self.widths = array("d")
+        self.heights = array("d")
+        self.known = bytearray()
+        self.unknown = 0
+        self._offsets = array("d", [0.0])
+        self._stale = None
+        self.height = 0.0
+        self.widest = 0.0
+        self.smallest = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _extent_add(self, w, h):
+        if w > self.widest:
+            self.widest = w
+        side = min(w, h)
+        if self.smallest is None or side < self.smallest:
+            self.smallest = side
+
+    def append(self, page_id, w, h):
+        w = float(w)
+        h = float(h)
+        self.index[page_id] = len(self.ids)
+        self.ids.append(page_id)
+        self.widths.append(w)
+        self.heights.append(h)
+        self.known.append(1)
+        offsets = self.offsets
+        offsets.append(offsets[-1] + h)
+        self.height = offsets[-1]
+        self._extent_add(w, h)
+
+    def load(self, ids, sizes):
+        """Add pages of known ids and sizes in bulk"""
+        first = len(self.ids)
+        self.ids.extend(ids)
+        for w, h in sizes:
+            self.widths.append(w)
+            self.heights.append(h)
+            self._extent_add(w, h)
+        self.known.extend(b"\x01" * (len(self.ids) - first))
+        offsets = self.offsets
+        y = offsets[-1]
+        for i in range(first, len(self.ids)):
+            self.index[self.ids[i]] = i
+            y += self.heights[i]
+            offsets.append(y)
+        self.height = y
+
+    def estimate(self, count, w, h):
+        """Lay out count pages of size w x h until their sizes are set"""
+        w = float(w)
+        h = float(h)
+        self.ids = array("l", [0]) * count
+        self.index = {}
+        self.widths = array("d", [w]) * count
+        self.heights = array("d", [h]) * count
+        self.known = bytearray(count)
+        self.unknown = count
+        self._offsets = array("d", [i * h for i in range(count + 1)])
+        self._stale = None
+        self.height = self._offsets[-1]
+        self.widest = 0.0
+        self.smallest = None
+        self._extent_add(w, h)
+
+    def set(self, pg_num, page_id, w, h):
+        """Set the real size of an estimated page, True if it changed"""
+        w = float(w)
+        h = float(h)
+        old_id = self.ids[pg_num]
+        if old_id and self.index.get(old_id) == pg_num:
+            del self.index[old_id]
+        self.ids[pg_num] = page_id
+        self.index[page_id] = pg_num
+        if not self.known[pg_num]:
+            self.known[pg_num] = 1
+            self.unknown -= 1
+        self._extent_add(w, h)
+        if w == self.widths[pg_num] and h == self.heights[pg_num]:
+            return False
+        self.widths[pg_num] = w
+        old_h = self.heights[pg_num]
+        if h != old_h:
+            self.heights[pg_num] = h
+            # the height is kept up to date, only the offsets wait
+            self.height += h - old_h
+            if self._stale is None or pg_num < self._stale:
+                self._stale = pg_num
+        return True
+
+    @property
+    def offsets(self):
+        # offsets below a changed page height are summed up again lazily,
+        # once for any number of changes
+        start = self._stale
+        if start is not None:
+            self._stale = None
+            offsets = self._offsets
+            heights = self.heights
+            y = offsets[start]
+            for i in range(start, len(heights)):
+                y += heights[i]
+                offsets[i + 1] = y
+            self.height = y
+        return self._offsets
+
+    def size(self, pg_num):
+        return self.widths[pg_num], self.heights[pg_num]
+
+    def page_num(self, page_id):
+        """Index of the page with the given id, or None"""
+        return self.index.get(page_id)
+
+    def page_at(self, y):
+        """Index of the page covering the vertical position y"""
+        count = len(self.ids)
+        if not count:
+            return None
+        i = bisect_right(self.offsets, y) - 1
+        return min(max(i, 0), count - 1)
+
+    def range_between(self, top, bottom):
+        """First and last index of the pages intersecting [top, bottom)"""
+        if not self.ids or bottom <= 0 or top >= self.height or bottom <= top:
+            return None
+        return self.page_at(top), self.page_at(bottom - 1e-6)
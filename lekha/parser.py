@@ -0,0 +1,518 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Reading the structure of a document with PyPDF2
+
+PyPDF2 is pure Python and holds the GIL while it parses, which stalls the
+main loop even when it runs in a thread. ParserPool parses documents in
+helper processes instead and sends back only compact results: page
+sizes, page ids, metadata and the top level of the outlines.
+
+The outline tree is read one level at a time, the children of an entry
+when it is expanded.
+"""
+
+import io
+import os
+import mmap
+import logging
+
+import PyPDF2
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject
+from PyPDF2.utils import PdfReadError, isString
+
+from .util import process_pool
+
+log = logging.getLogger("lekha")
+
+METADATA_FIELDS = "title", "author", "subject", "creator", "producer"
+
+#: Fit types of destinations and their arguments:
+#: /XYZ left top zoom, /Fit, /FitH top, /FitV left,
+#: /FitR left bottom right top, /FitB, /FitBH top, /FitBV left
+FIT_TYPES = "/XYZ", "/Fit", "/FitH", "/FitV", "/FitR", "/FitB", "/FitBH", \
+    "/FitBV"
+
+
+class Outline(object):
+
+    """Outline entry detached from the PyPDF2 document
+
+    typ is the fit type of the destination and args its arguments, see
+    FIT_TYPES. key is the object number of the entry. children is None
+    for a leaf, the (idnum, generation) reference of the first child
+    entry until the child level is read, then a list of Outline. Entries
+    pointing to a named destination keep the name in name, their page_id
+    is None until the name is resolved. page_num is the number of the
+    page, found through the page tree, or None if it could not be found.
+    """
+
+    __slots__ = (
+        "title", "typ", "args", "page_id", "children", "name", "key",
+        "page_num")
+
+    def __init__(
+            self, title, typ=None, args=(), page_id=None, children=None,
+            name=None, key=None, page_num=None):
+        self.title = title
+        self.typ = typ
+        self.args = args
+        self.page_id = page_id
+        self.children = children
+        self.name = name
+        self.key = key
+        self.page_num = page_num
+
+    def __getstate__(self):
+        return (
+            self.title, self.typ, self.args, self.page_id, self.children,
+            self.name, self.key, self.page_num)
+
+    def __setstate__(self, state):
+        (
+            self.title, self.typ, self.args, self.page_id, self.children,
+            self.name, self.key, self.page_num) = state
+
+    @property
+    def expandable(self):
+        return self.children is not None and self.children != []
+
+    @property
+    def resolved(self):
+        return not isinstance(self.children, tuple)
+
+
+def open_mapped(path):
+    """A read-only, seekable memory map of a file for PdfFileReader
+
+    Given a path PyPDF2 reads the whole file into a private buffer. A map
+    is backed by the kernel page cache instead, so only the parts used
+    are resident and they are shared by every reader of the file. The
+    file must not change while mapped, a read past the end of a file
+    truncated in place raises SIGBUS. Users of a map check the size and
+    mtime of the file before reading.
+    """
+    with open(path, "rb") as fp:
+        try:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # empty files, or files that cannot be mapped
+            return io.BytesIO(fp.read())
+
+
+def reader(path):
+    return PyPDF2.PdfFileReader(open_mapped(path))
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get(obj, key, default=None):
+    # dict.get() of a DictionaryObject does not resolve indirect objects
+    return obj[key] if key in obj else default
+
+
+def _ref(obj, key):
+    """(idnum, generation) of the indirect object under key, or None"""
+    if key not in obj:
+        return None
+    ref = obj.raw_get(key)
+    if not isinstance(ref, IndirectObject):
+        return None
+    return ref.idnum, ref.generation
+
+
+def _resolve(doc, ref):
+    return doc.getObject(IndirectObject(ref[0], ref[1], doc))
+
+
+class PageNumbers(object):
+
+    """Page numbers of page objects, found through the page tree
+
+    Walks up from a page to the root of the page tree, adding up the
+    page counts of the kids before it on each level, so the pages need
+    not be read in order first. The kids of every node are counted up
+    front by load(), which reads the whole page tree and belongs in a
+    thread or a helper process. number() only looks them up.
+    """
+
+    def __init__(self):
+        self._offsets = {}
+
+    def load(self, doc):
+        """Count the kids of every node of the page tree of doc"""
+        stack = [doc.trailer["/Root"].raw_get("/Pages")]
+        while stack:
+            ref = stack.pop()
+            if (
+                    not isinstance(ref, IndirectObject) or
+                    ref.idnum in self._offsets):
+                continue
+            offsets = self._offsets[ref.idnum] = {}
+            count = 0
+            for kid in _get(ref.getObject(), "/Kids", ()):
+                offsets[getattr(kid, "idnum", None)] = count
+                node = kid.getObject()
+                if _get(node, "/Type") == "/Pages":
+                    count += int(_get(node, "/Count", 0))
+                    stack.append(kid)
+                else:
+                    count += 1
+
+    def number(self, page):
+        """Page number of an indirect page object, or None"""
+        if not isinstance(page, IndirectObject):
+            return None
+        pg_num = 0
+        node_id = page.idnum
+        seen = set()
+        try:
+            node = page.getObject()
+            # broken documents may link the nodes in a loop
+            while "/Parent" in node and node_id not in seen:
+                seen.add(node_id)
+                parent = node.raw_get("/Parent")
+                if not isinstance(parent, IndirectObject):
+                    return None
+                node = parent.getObject()
+                offset = self._offsets.get(parent.idnum, {}).get(node_id)
+                if offset is None:
+                    return None
+                pg_num += offset
+                node_id = parent.idnum
+        except (KeyError, TypeError, ValueError, PdfReadError):
+            return None
+        return pg_num
+
+
+def page_numbers(doc):
+    """PageNumbers of doc with its page tree loaded, or None"""
+    pages = PageNumbers()
+    try:
+        pages.load(doc)
+    except Exception as e:
+        log.info("page tree could not be read: %r", e)
+        return None
+    return pages
+
+
+def _dest_array(dest):
+    if isinstance(dest, DictionaryObject):
+        dest = _get(dest, "/D")
+    if not isinstance(dest, ArrayObject) or len(dest) < 2:
+        return None
+    return dest
+
+
+def destination(dest):
+    """Page id, fit type and arguments of a destination, or None
+
+    The arguments are numbers, or None where the destination leaves a
+    value unchanged.
+    """
+    dest = _dest_array(dest)
+    if dest is None:
+        return None
+    # destinations in other documents give page numbers, not pages
+    page_id = getattr(dest[0], "idnum", None)
+    typ = u"%s" % dest[1]
+    if page_id is None or typ not in FIT_TYPES:
+        return None
+    return page_id, typ, tuple(_number(value) for value in dest[2:])
+
+
+def destination_set(outline, dest, pages=None):
+    """Set the page and position of outline from a destination
+
+    With a PageNumbers in pages the number of the page is set too.
+    """
+    entry = destination(dest)
+    if entry is None:
+        return
+    outline.page_id, outline.typ, outline.args = entry
+    if pages is not None:
+        outline.page_num = pages.number(_dest_array(dest)[0])
+
+
+def _node_dest(node):
+    if "/A" in node:
+        action = node["/A"]
+        if _get(action, "/S") == "/GoTo":
+            return _get(action, "/D")
+    elif "/Dest" in node:
+        return node["/Dest"]
+    return None
+
+
+def _outline(node, key, dests, pages):
+    outline = Outline(
+        u"%s" % _get(node, "/Title", u""),
+        children=_ref(node, "/First"), key=key)
+    dest = _node_dest(node)
+    if isString(dest):
+        outline.name = u"%s" % dest
+        dest = dests.get(outline.name) if dests is not None else None
+    if dest is not None:
+        destination_set(outline, dest, pages)
+    return outline
+
+
+def _first_ref(doc):
+    try:
+        return _ref(doc.trailer["/Root"]["/Outlines"], "/First")
+    except (KeyError, PdfReadError):
+        return None
+
+
+def outline_level(doc, ref=None, dests=None, pages=None):
+    """Generator of the Outline entries of one level of the outline tree
+
+    ref is the reference of the first entry of the level, None for the
+    top level. Named destinations are looked up in the dict dests, page
+    numbers in the PageNumbers pages. Only the entries of the level are
+    read, not their children.
+    """
+    if ref is None:
+        ref = _first_ref(doc)
+
+    seen = set()
+    # broken documents may link the entries in a loop
+    while ref is not None and ref[0] not in seen:
+        seen.add(ref[0])
+        node = _resolve(doc, ref)
+        outline = _outline(node, ref[0], dests, pages)
+        if outline.page_id is not None or outline.name or outline.children:
+            yield outline
+        ref = _ref(node, "/Next")
+
+
+def destination_table(doc, index, names=None):
+    """Generator of the destinations of all the outline entries
+
+    Walks the whole outline tree an entry per step. Yields
+    (key, (pg_num, typ, args)) for the entries pointing to a page in
+    index, a dict of page ids to page numbers, and None for the rest.
+    Unless given in the dict names, the named destinations are read on
+    the first named entry, a name per step.
+    """
+    stack = [_first_ref(doc)]
+    seen = set()
+    while stack:
+        ref = stack.pop()
+        if ref is None or ref[0] in seen:
+            continue
+        seen.add(ref[0])
+        node = _resolve(doc, ref)
+        stack.append(_ref(node, "/Next"))
+        stack.append(_ref(node, "/First"))
+
+        dest = _node_dest(node)
+        if isString(dest):
+            if names is None:
+                names = {}
+                for name, value in named_destinations(doc):
+                    names[name] = value
+                    yield None
+            dest = names.get(u"%s" % dest)
+        entry = destination(dest)
+        if entry is None or entry[0] not in index:
+            yield None
+            continue
+        page_id, typ, args = entry
+        yield ref[0], (index[page_id], typ, args)
+
+
+def named_destinations(doc):
+    """Generator of the named destinations of a document
+
+    Yields (name, destination) pairs walking the name tree one node at a
+    time.
+    """
+    catalog = doc.trailer["/Root"]
+    if "/Dests" in catalog:
+        dests = catalog["/Dests"]
+        for name in dests:
+            yield u"%s" % name, dests[name]
+    names = _get(catalog, "/Names")
+    if names is None or "/Dests" not in names:
+        return
+    stack = [names["/Dests"]]
+    while stack:
+        node = stack.pop()
+        for kid in reversed(_get(node, "/Kids", ())):
+            stack.append(kid.getObject())
+        pairs = _get(node, "/Names", ())
+        for i in range(0, len(pairs) - 1, 2):
+            yield u"%s" % pairs[i].getObject(), pairs[i + 1].getObject()
+
+
+def outlines_resolve(outlines, dests, pages=None):
+    """Set the destinations of the named entries in a tree of Outline"""
+    stack = [outlines]
+    while stack:
+        for outline in stack.pop():
+            if outline.name and outline.page_id is None:
+                dest = dests.get(outline.name)
+                if dest is not None:
+                    destination_set(outline, dest, pages)
+            if isinstance(outline.children, list):
+                stack.append(outline.children)
+
+
+def metadata(doc):
+    """Document info as a dict of METADATA_FIELDS, or None"""
+    info = doc.getDocumentInfo()
+    if not info:
+        return None
+    return dict(
+        (name, getattr(info, name) and u"%s" % getattr(info, name))
+        for name in METADATA_FIELDS)
+
+
+def parse(path, password=None, pages=True):
+    """Read the structure of a document, run in a helper process
+
+    Returns a dict with the keys encrypted, page_count, sizes, ids,
+    metadata and outlines. An encrypted document without the right
+    password only has encrypted set. Unless pages is true, the pages are
+    not read and page_count, sizes and ids are left out, for documents
+    whose page geometry is cached.
+    """
+    doc = _cached_reader(path, password, reopen=True)
+    if doc is None:
+        return {"encrypted": True}
+
+    result = {"encrypted": False}
+    if pages:
+        sizes = []
+        ids = []
+        for pg_num in range(doc.getNumPages()):
+            pg = doc.getPage(pg_num)
+            mbox = pg.mediaBox
+            sizes.append((float(mbox[2]), float(mbox[3])))
+            ids.append(pg.indirectRef.idnum)
+        result.update(page_count=len(sizes), sizes=sizes, ids=ids)
+
+    try:
+        info = metadata(doc)
+    except Exception as e:
+        log.warn("Metadata could not be read from the document: %r", e)
+        info = None
+
+    try:
+        outlines = _outlines(doc, None)
+    except Exception as e:
+        log.warn("Outlines could not be read from the document: %r", e)
+        outlines = []
+
+    result.update(metadata=info, outlines=outlines)
+    return result
+
+
+# the last document parsed in a helper process, with its named
+# destinations once read: path, mtime, reader, destinations, PageNumbers
+_last = None
+
+
+def _cached_reader(path, password=None, reopen=False):
+    """Reader of path kept for the outline levels read after parse()
+
+    Returns None if the document is encrypted and password is wrong.
+    """
+    global _last
+    mtime = os.stat(path).st_mtime
+    if reopen or _last is None or _last[:2] != [path, mtime]:
+        _last = None
+        doc = reader(path)
+        if doc.isEncrypted:
+            if password is None or not doc.decrypt(password):
+                return None
+        _last = [path, mtime, doc, None, None]
+    return _last[2]
+
+
+def _outlines(doc, ref):
+    if _last[4] is None:
+        _last[4] = page_numbers(doc)
+    pages = _last[4]
+    outlines = list(outline_level(doc, ref, pages=pages))
+    if any(outline.name for outline in outlines):
+        if _last[3] is None:
+            _last[3] = dict(named_destinations(doc))
+        outlines_resolve(outlines, _last[3], pages)
+    return outlines
+
+
+def outline_children(path, password, ref):
+    """Read a level of the outline tree, run in a helper process"""
+    doc = _cached_reader(path, password)
+    if doc is None:
+        raise PdfReadError("document could not be decrypted")
+    return _outlines(doc, ref)
+
+
+def destination_list(path, password, ids):
+    """Destination table of a document, run in a helper process
+
+    ids are the page ids of the document in page order.
+    """
+    doc = _cached_reader(path, password)
+    if doc is None:
+        raise PdfReadError("document could not be decrypted")
+    index = dict((page_id, pg_num) for pg_num, page_id in enumerate(ids))
+    return [item for item in destination_table(doc, index) if item]
+
+
+class ParserPool(object):
+
+    """Helper processes parsing documents, see parse()"""
+
+    def __init__(self, processes=2):
+        self.pool = process_pool(processes)
+
+    def parse(
+            self, group, path, password=None, pages=True, done_cb=None,
+            error_cb=None):
+        """Parse in the pool as a job of the given JobGroup"""
+        return group.submit(
+            self.pool, parse, path, password, pages,
+            done_cb=done_cb, error_cb=error_cb)
+
+    def outline_level(
+            self, group, path, password, ref, done_cb=None, error_cb=None):
+        """Read the outline level starting at ref, see outline_level()"""
+        return group.submit(
+            self.pool, outline_children, path, password, ref,
+            done_cb=done_cb, error_cb=error_cb)
+
+    def destinations(
+            self, group, path, password, ids, done_cb=None, error_cb=None):
+        """Build the destination table, see destination_table()"""
+        return group.submit(
+            self.pool, destination_list, path, password, ids,
+            done_cb=done_cb, error_cb=error_cb)
+
+    def shutdown(self):
+        self.pool.terminate()
@@ -0,0 +1,185 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import time
+import logging
+import sqlite3
+
+from efl.ecore import Timer
+from xdg import BaseDirectory
+
+from . import instrument
+
+log = logging.getLogger("lekha")
+
+
+class PositionStore(object):
+
+    """Zoom and scroll position of documents kept in an SQLite database
+
+    Positions are written in batches, at most DEBOUNCE seconds after a
+    change, so scrolling does not touch the disk on every step and a crash
+    loses at most the last few seconds. Only the documents being opened are read.
+    Entries of the documents not opened for the longest time are removed
+    when there are more than max_entries.
+    """
+
+    #: Seconds from a change until pending positions are written
+    DEBOUNCE = 2.0
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS positions (
+            path TEXT PRIMARY KEY,
+            zoom REAL NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            w INTEGER NOT NULL,
+            h INTEGER NOT NULL,
+            used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS positions_used ON positions (used);
+        """
+
+    def __init__(self, path=None, max_entries=1000):
+        cfg_base_path = BaseDirectory.save_config_path("lekha")
+        if path is None:
+            path = os.path.join(cfg_base_path, "positions.sqlite")
+        self.max_entries = max_entries
+        self.pending = {}
+        self._timer = None
+
+        self.db = None
+        try:
+            self.db = self._connect(path)
+            self._migrate(os.path.join(cfg_base_path, "document_positions"))
+        except (sqlite3.Error, OSError) as e:
+            # a broken store must not keep Lekha from starting
+            log.warn("document positions could not be restored: %r", e)
+            if self.db is not None:
+                self.db.close()
+            self.db = self._connect(":memory:")
+
+    def _connect(self, path):
+        db = sqlite3.connect(path)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(self.SCHEMA)
+        except sqlite3.Error:
+            db.close()
+            raise
+        return db
+
+    @staticmethod
+    def _key(doc_path):
+        return os.path.abspath(doc_path)
+
+    def _migrate(self, json_path):
+        """Import the positions of the JSON file used by earlier versions"""
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, "r") as fp:
+                doc_specs = json.load(fp)
+        except Exception as e:
+            log.info("old document positions could not be read: %r", e)
+            doc_specs = {}
+        now = time.time()
+        rows = []
+        for doc_path, spec in doc_specs.items():
+            try:
+                zoom, (x, y, w, h) = spec
+                rows.append((
+                    self._key(doc_path), float(zoom),
+                    int(x), int(y), int(w), int(h), now))
+            except (TypeError, ValueError):
+                continue
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO positions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows)
+        self._evict()
+        os.rename(json_path, json_path + ".old")
+        log.info("%d document positions imported", len(rows))
+
+    def get(self, doc_path):
+        """Zoom and position of a document, or None"""
+        key = self._key(doc_path)
+        if key in self.pending:
+            zoom, pos = self.pending[key]
+            return zoom, list(pos)
+        row = self.db.execute(
+            "SELECT zoom, x, y, w, h FROM positions WHERE path = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        with self.db:
+            self.db.execute(
+                "UPDATE positions SET used = ? WHERE path = ?",
+                (time.time(), key))
+        return row[0], list(row[1:])
+
+    def put(self, doc_path, zoom, pos):
+        """Queue a position change, written within DEBOUNCE seconds"""
+        self.pending[self._key(doc_path)] = float(zoom), tuple(pos)
+        # a pending write picks up this change too, restarting the timer
+        # would postpone it for as long as the view keeps moving
+        if self._timer is None:
+            self._timer = Timer(
+                self.DEBOUNCE, instrument.timed(self._flush_cb, "timer"))
+
+    def _flush_cb(self):
+        self._timer = None
+        self.flush()
+        return False
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.delete()
+            self._timer = None
+        if not self.pending:
+            return
+        now = time.time()
+        rows = [
+            (key, zoom, int(x), int(y), int(w), int(h), now)
+            for key, (zoom, (x, y, w, h)) in self.pending.items()
+            ]
+        self.pending.clear()
+        try:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO positions "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._evict()
+        except sqlite3.Error as e:
+            log.warn("document positions could not be saved: %r", e)
+
+    def _evict(self):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM positions WHERE path NOT IN ("
+                "SELECT path FROM positions ORDER BY used DESC LIMIT ?)",
+                (self.max_entries,))
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,110 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+
+class Prefetcher(object):
+
+    """Predicts which pages are about to enter the viewport
+
+    Follows the direction and smoothed speed of scrolling. At rest one page
+    past the visible ones is fetched, faster scrolling reaches up to
+    ``pages`` pages ahead as long as their estimated bitmaps fit in the
+    memory budget. The speed fades out over LOOKAHEAD seconds without
+    scrolling, the view is at rest after that. The range is worked out
+    again only when asked for, the caller asks once more at rest.
+    """
+
+    #: Seconds of scrolling at the current speed to look ahead
+    LOOKAHEAD = 0.5
+    #: Weight of the latest sample in the smoothed scroll speed
+    SMOOTHING = 0.3
+    #: Bytes per zoomed square unit of a page, preview (1/4) plus hq (4x4)
+    BYTES_PER_UNIT = 4 * (0.25 + 4.0)
+
+    def __init__(self, table, pages=3, budget_mb=32):
+        self.table = table
+        self.pages = pages
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.direction = 1
+        self.speed = 0.0
+        self._last = None
+
+    def scrolled(self, y, now=None):
+        if now is None:
+            now = time.time()
+        if self._last is not None:
+            last_y, last_t = self._last
+            dy = y - last_y
+            dt = now - last_t
+            if dy:
+                self.direction = 1 if dy > 0 else -1
+            if dt > self.LOOKAHEAD:
+                # the view came to rest since, the old speed is gone
+                self.speed = 0.0
+            if dt > 0:
+                speed = abs(dy) / dt
+                self.speed += self.SMOOTHING * (speed - self.speed)
+        self._last = y, now
+
+    def current_speed(self, now=None):
+        """Scroll speed faded by the time since the last scroll"""
+        if self._last is None:
+            return 0.0
+        if now is None:
+            now = time.time()
+        idle = now - self._last[1]
+        if idle >= self.LOOKAHEAD:
+            return 0.0
+        return self.speed * (1.0 - max(idle, 0.0) / self.LOOKAHEAD)
+
+    def page_bytes(self, pg_num, zoom):
+        w, h = self.table.size(pg_num)
+        return int(w * h * zoom * zoom * self.BYTES_PER_UNIT)
+
+    def range(self, visible, zoom, now=None):
+        """First and last index of the pages to prefetch, or None"""
+        if visible is None or self.pages < 1:
+            return None
+        first, last = visible
+        table = self.table
+        avg_h = (table.offsets[last + 1] - table.offsets[first]) * zoom
+        avg_h /= last - first + 1
+        count = 1
+        if avg_h > 0:
+            count += int(self.current_speed(now) * self.LOOKAHEAD / avg_h)
+        count = min(count, self.pages)
+
+        if self.direction > 0:
+            candidates = range(last + 1, min(last + 1 + count, len(table)))
+        else:
+            candidates = range(first - 1, max(first - 1 - count, -1), -1)
+
+        used = 0
+        picked = []
+        for pg_num in candidates:
+            used += self.page_bytes(pg_num, zoom)
+            if used > self.budget:
+                break
+            picked.append(pg_num)
+        if not picked:
+            return None
+        return min(picked), max(picked)
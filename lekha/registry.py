@@ -0,0 +1,640 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import logging
+
+from .pagetable import PageTable
+from .cache import document_fingerprint
+from . import jobs
+from . import scheduler
+from . import parser as doc_parser
+from .search import SearchIndex
+from . import memory
+from .instrument import clock
+
+log = logging.getLogger("lekha")
+
+#: Reading the document
+READING = "reading"
+#: Waiting for a password
+ENCRYPTED = "encrypted"
+#: Page count, metadata and a page layout are known
+OPENED = "opened"
+#: The document could not be read
+FAILED = "failed"
+
+
+class SharedDocument(object):
+
+    """The reader, page table and outlines of one file
+
+    Shared by all the views (tabs) showing the file, the file is read and
+    its pages populated once. Views are told about the progress through
+    their methods:
+
+    - shared_opened(): page count, metadata and a page layout are known
+    - shared_encrypted(): a password is needed, only the first view
+    - shared_pages_changed(pg_nums): pages got their real size
+    - shared_outlines(outlines): the top level of the outline tree
+    - shared_error(exc)
+
+    The outline tree is read level by level, see outline_children().
+    """
+
+    def __init__(self, app, key, path):
+        self.app = app
+        self.key = key
+        self.path = path
+        self.views = []
+        self.state = READING
+        self.error = None
+        self.doc = None
+        self.file_stat = None
+        self.file_changed = False
+        self.page_count = 0
+        self.fingerprint = None
+        self.geometry = None
+        self.metadata = None
+        self.outlines = None
+        self.dests = None
+        self.destinations = None
+        self.page_numbers = None
+        self._dests_reading = False
+        self._outline_waiters = {}
+        self.table = PageTable()
+        self.password = None
+        self.search = None
+        self.jobs = jobs.JobGroup(jobs.runner())
+
+    def view_add(self, view):
+        """Add a view, bringing it up to date with the document"""
+        self.views.append(view)
+        if len(self.views) == 1 and self.state == READING:
+            self.read()
+        elif self.state == OPENED:
+            view.shared_opened()
+            if self.outlines is not None:
+                view.shared_outlines(self.outlines)
+        elif self.state == FAILED:
+            view.shared_error(self.error)
+
+    def read(self):
+        if self.app.parser is not None:
+            self.jobs.run(
+                self._geometry_load, self.path, self.app.geometry_cache,
+                done_cb=self._geometry_loaded, error_cb=self._read_error)
+        else:
+            self.jobs.run(
+                self._read_worker, self.path, self.app.geometry_cache,
+                done_cb=self._read_done, error_cb=self._read_error)
+
+    @staticmethod
+    def _geometry_load(path, geometry_cache):
+        """Fingerprint and cached page geometry of a file, or None"""
+        fingerprint = geometry = None
+        try:
+            fingerprint = document_fingerprint(path)
+            geometry = geometry_cache.load(fingerprint)
+        except Exception as e:
+            log.info("page geometry cache could not be used: %r", e)
+        return fingerprint, geometry
+
+    def _geometry_loaded(self, result):
+        """Parse in a helper process, reading the pages only if not cached"""
+        self.fingerprint, self.geometry = result
+        self.app.parser.parse(
+            self.jobs, self.path, pages=self.geometry is None,
+            done_cb=self._parsed, error_cb=self._read_error)
+
+    @classmethod
+    def _read_worker(cls, path, geometry_cache):
+        t1 = clock()
+        fingerprint, geometry = cls._geometry_load(path, geometry_cache)
+        st = os.stat(path)
+        doc = doc_parser.reader(path)
+        pages = None
+        if geometry is not None:
+            page_count = geometry["page_count"]
+        else:
+            page_count = doc.getNumPages()
+            # outline pages are found through the page tree until the
+            # page table is populated, counted here off the main loop
+            pages = doc_parser.page_numbers(doc)
+        t2 = clock()
+        log.info("Reading the doc took: %f", t2-t1)
+        return (
+            doc, page_count, fingerprint, geometry, pages,
+            (st.st_size, st.st_mtime))
+
+    def _read_done(self, result):
+        (
+            self.doc, self.page_count, self.fingerprint, self.geometry,
+            self.page_numbers, self.file_stat) = result
+        if not self.page_count:
+            self._read_error(ValueError("the document has no pages"))
+            return
+
+        try:
+            encrypted = self.doc.isEncrypted
+        except Exception as e:
+            self._read_error(e)
+            return
+        if encrypted:
+            self._encrypted()
+            return
+
+        self.metadata_read()
+        self.open()
+
+    def _read_error(self, e):
+        log.error("Document could not be opened because: %r", e)
+        self.state = FAILED
+        self.error = e
+        for view in self.views:
+            view.shared_error(e)
+
+    def _parsed(self, result):
+        """Use the structure of the document read by a helper process"""
+        if result["encrypted"]:
+            self._encrypted()
+            return
+        if "sizes" in result:
+            self.geometry = result
+        self.page_count = self.geometry["page_count"]
+        if not self.page_count:
+            self._read_error(ValueError("the document has no pages"))
+            return
+        self.outlines = result["outlines"]
+        self.metadata = result["metadata"]
+        if not self.metadata:
+            log.warn("Metadata information could not be extracted from the document")
+        self.open()
+
+    def _encrypted(self):
+        self.state = ENCRYPTED
+        self.views[0].shared_encrypted()
+
+    def decrypt(self, password, done_cb):
+        """Open an encrypted document
+
+        done_cb(ok) is called with True if the password was right.
+        """
+        if self.app.parser is not None:
+            def parsed(result):
+                done_cb(not result["encrypted"])
+                if not result["encrypted"]:
+                    self.password = password
+                    self._parsed(result)
+
+            self.app.parser.parse(
+                self.jobs, self.path, password,
+                pages=self.geometry is None,
+                done_cb=parsed, error_cb=self._read_error)
+            return
+
+        try:
+            self._reader_check()
+            ret = self.doc.decrypt(password)
+        except Exception:
+            log.exception("Could not decrypt the document")
+            return
+        done_cb(bool(ret))
+        if ret:
+            self.password = password
+            self.metadata_read()
+            self.open()
+
+    def metadata_read(self):
+        try:
+            self._reader_check()
+            self.metadata = doc_parser.metadata(self.doc)
+        except Exception:
+            self.metadata = None
+        if not self.metadata:
+            log.warn("Metadata information could not be extracted from the document")
+
+    def open(self):
+        """Lay out the pages and start populating their real sizes
+
+        A document failing here, like one with a broken first page, is
+        reported to the views as an error.
+        """
+        try:
+            self._open()
+        except Exception as e:
+            log.exception("Document could not be laid out")
+            self._read_error(e)
+
+    def _open(self):
+        """Lay out the pages, see open()
+
+        Without cached page geometry every page is first laid out with the
+        size of the first one, so the views can show their positions right
+        away. The real sizes are then read in the background, the pages
+        around the viewports first, while the top level of the outlines
+        is read.
+        """
+        self._reader_check()
+        table = self.table
+        if self.geometry is not None:
+            table.load(self.geometry["ids"], self.geometry["sizes"])
+            self.destinations = self.geometry.get("destinations")
+        else:
+            pg = self.doc.getPage(0)
+            mbox = pg.mediaBox
+            table.estimate(self.page_count, mbox[2], mbox[3])
+            table.set(0, pg.indirectRef.idnum, mbox[2], mbox[3])
+
+        self.state = OPENED
+        for view in self.views:
+            view.shared_opened()
+
+        self.outlines_read()
+
+        if self.geometry is not None:
+            self.destinations_build()
+            return
+
+        anchor = self.views[0].anchor if self.views else None
+        start = anchor[0] if anchor is not None else 0
+        self.app.scheduler.idle_add(
+            self, scheduler.POPULATE, self.populate_page,
+            self._populate_order(start, self.page_count))
+
+    @staticmethod
+    def _populate_order(start, count):
+        """Page numbers by distance from start, the following ones first"""
+        yield start
+        for d in range(1, count):
+            if start + d >= count and start - d < 0:
+                break
+            if start + d < count:
+                yield start + d
+            if start - d >= 0:
+                yield start - d
+
+    def _populate_next(self, itr):
+        known = self.table.known
+        for view in self.views:
+            for rng in view.visible_range, view.prefetch_range:
+                if rng is None:
+                    continue
+                for pg_num in range(rng[0], rng[1] + 1):
+                    if not known[pg_num]:
+                        return pg_num
+        for pg_num in itr:
+            if not known[pg_num]:
+                return pg_num
+        return None
+
+    def populate_page(self, itr):
+        """Set the real size of pages for a time slice
+
+        The views are told about the changed pages once per slice, their
+        layout is not updated page by page.
+        """
+        try:
+            self._reader_check()
+        except IOError:
+            return False
+        table = self.table
+        changed = []
+        end = clock() + scheduler.Scheduler.TIME_SLICE
+        while True:
+            pg_num = self._populate_next(itr)
+            if pg_num is None:
+                break
+
+            pg = self.doc.getPage(pg_num)
+            mbox = pg.mediaBox
+            w, h = mbox[2], mbox[3]
+
+            if table.set(pg_num, pg.indirectRef.idnum, w, h):
+                changed.append(pg_num)
+            if clock() >= end:
+                break
+
+        if changed:
+            for view in self.views:
+                view.shared_pages_changed(changed)
+        if pg_num is None:
+            # the page ids are all known now
+            self.page_numbers = None
+            if self.destinations is None:
+                # saved with the destination table once it is built
+                self.destinations_build()
+            else:
+                self.geometry_save()
+            return False
+        return True
+
+    def geometry_save(self):
+        """Cache the page table and destinations in a thread"""
+        if self.fingerprint is None or self.file_changed:
+            return
+        table = self.table
+        destinations = self.destinations
+        if destinations is not None:
+            destinations = dict(destinations)
+        # copies, population may go on while the job runs
+        self.jobs.run(
+            self.app.geometry_cache.save, self.fingerprint,
+            zip(table.widths[:], table.heights[:]), table.ids[:],
+            destinations, error_cb=self._geometry_save_error)
+
+    def _geometry_save_error(self, e):
+        log.info("page geometry could not be cached: %r", e)
+
+    def destinations_build(self):
+        """Build the destination table of the outline entries when idle
+
+        The table maps the keys of Outline entries to their page number,
+        fit type and arguments. It needs the ids of all the pages and is
+        saved with the page geometry.
+        """
+        if self.destinations is not None:
+            return
+        if self.app.parser is not None:
+            self.app.parser.destinations(
+                self.jobs, self.path, self.password, self.table.ids,
+                done_cb=lambda items: self._destinations_set(dict(items)),
+                error_cb=self._destinations_error)
+            return
+        self.app.scheduler.idle_add(
+            self, scheduler.POPULATE, self._destinations_step,
+            doc_parser.destination_table(
+                self.doc, self.table.index, self.dests), {})
+
+    def _destinations_step(self, itr, destinations):
+        try:
+            self._reader_check()
+            item = next(itr)
+        except StopIteration:
+            self._destinations_set(destinations)
+            return False
+        except Exception as e:
+            self._destinations_error(e)
+            return False
+        if item is not None:
+            destinations[item[0]] = item[1]
+        return True
+
+    def _destinations_set(self, destinations):
+        self.destinations = destinations
+        self.geometry_save()
+
+    def _destinations_error(self, e):
+        log.warn("Outline destinations could not be read: %r", e)
+        # the pages are cached without the table, it is built again later
+        self.geometry_save()
+        self.destinations = {}
+
+    def destination(self, outline):
+        """Page number, fit type and arguments of an Outline, or None"""
+        if self.destinations is not None:
+            dest = self.destinations.get(outline.key)
+            if dest is not None:
+                return dest
+        # found through the page tree when the level was read, the page
+        # may not be populated yet
+        pg_num = outline.page_num
+        if pg_num is not None and pg_num < self.page_count:
+            return pg_num, outline.typ, outline.args
+        if outline.page_id is None:
+            return None
+        pg_num = self.table.page_num(outline.page_id)
+        if pg_num is None:
+            return None
+        return pg_num, outline.typ, outline.args
+
+    def outlines_read(self):
+        """Read the top level of the outline tree, unless already read"""
+        if self.outlines is not None:
+            self._outlines_set(self.outlines)
+            return
+
+        t1 = clock()
+
+        def outlines_done(outlines):
+            t2 = clock()
+            log.info("Fetching outlines took: %f", t2-t1)
+            self._outlines_set(outlines)
+
+        self.outline_level(None, outlines_done)
+
+    def _outlines_set(self, outlines):
+        self.outlines = outlines
+        for view in self.views:
+            view.shared_outlines(outlines)
+
+    def outline_children(self, outline, done_cb):
+        """Read the child level of an Outline, done_cb(children)"""
+        if outline.resolved:
+            done_cb(outline.children or [])
+            return
+
+        def level_read(children):
+            outline.children = children
+            done_cb(children)
+
+        self.outline_level(outline.children, level_read)
+
+    def outline_level(self, ref, done_cb):
+        """Read the level of the outline tree starting at ref
+
+        done_cb(outlines) gets a list of Outline, an empty one if the
+        level could not be read. With a parser pool the level is read in
+        a helper process, otherwise an entry at a time in the main loop,
+        as the reader is not safe to share with the page population.
+        """
+        waiters = self._outline_waiters.get(ref)
+        if waiters is not None:
+            waiters.append(done_cb)
+            return
+        self._outline_waiters[ref] = [done_cb]
+
+        if self.app.parser is not None:
+            self.app.parser.outline_level(
+                self.jobs, self.path, self.password, ref,
+                done_cb=lambda outlines: self._level_read(ref, outlines),
+                error_cb=lambda e: self._level_error(ref, e))
+            return
+
+        self.app.scheduler.idle_add(
+            self, scheduler.OUTLINES, self._outline_step, ref,
+            doc_parser.outline_level(
+                self.doc, ref, self.dests, self._page_numbers()), [])
+
+    def _page_numbers(self):
+        """PageNumbers while the page table is incomplete, or None
+
+        A complete table, like one from the geometry cache, finds the
+        pages of destinations by id, see destination().
+        """
+        if not self.table.unknown:
+            return None
+        return self.page_numbers
+
+    def _outline_step(self, ref, itr, outlines):
+        try:
+            self._reader_check()
+            outlines.append(next(itr))
+        except StopIteration:
+            self._level_read(ref, outlines)
+            return False
+        except Exception as e:
+            self._level_error(ref, e)
+            return False
+        return True
+
+    def _level_read(self, ref, outlines):
+        if self.app.parser is None and any(o.name for o in outlines):
+            if self.dests is not None:
+                doc_parser.outlines_resolve(
+                    outlines, self.dests, self._page_numbers())
+            else:
+                self._dests_read()
+        for done_cb in self._outline_waiters.pop(ref, ()):
+            done_cb(outlines)
+
+    def _level_error(self, ref, e):
+        log.warn("Outlines could not be read from the document: %r", e)
+        self._level_read(ref, [])
+
+    def _dests_read(self):
+        """Resolve the named destinations of the outlines when idle"""
+        if self._dests_reading:
+            return
+        self._dests_reading = True
+        self.app.scheduler.idle_add(
+            self, scheduler.OUTLINES, self._dests_step,
+            doc_parser.named_destinations(self.doc), {})
+
+    def _dests_step(self, itr, dests):
+        try:
+            self._reader_check()
+            name, dest = next(itr)
+        except StopIteration:
+            self.dests = dests
+            doc_parser.outlines_resolve(
+                self.outlines or [], dests, self._page_numbers())
+            return False
+        except Exception as e:
+            log.warn("Named destinations could not be read: %r", e)
+            self.dests = dests
+            return False
+        dests[name] = dest
+        return True
+
+    def _reader_check(self):
+        """Raise IOError if the file changed since the reader opened it
+
+        The reader maps the file, and reading a map of a file truncated in
+        place kills the process with SIGBUS. The main loop reads only
+        after this check, so they stop when the file is seen to change. A
+        change in the middle of a step is not caught.
+        """
+        if self.file_stat is None:
+            return
+        if not self.file_changed:
+            try:
+                st = os.stat(self.path)
+                self.file_changed = \
+                    (st.st_size, st.st_mtime) != self.file_stat
+            except OSError:
+                self.file_changed = True
+            if self.file_changed:
+                log.warn(
+                    "%s changed on disk, reopen it to see the changes",
+                    self.path)
+        if self.file_changed:
+            raise IOError("%s changed on disk" % self.path)
+
+    def search_index(self):
+        """The full-text search index of the document, made on first use"""
+        if self.search is None:
+            self.search = SearchIndex(
+                self.path, self.page_count, self.fingerprint, self.jobs,
+                self.password)
+        return self.search
+
+    def memory(self):
+        """Memory held for the file, shared by all its views"""
+        path = self.path
+        return {
+            "views": len(self.views),
+            "reader": memory.reader_usage(self.doc),
+            "page_table": memory.table_bytes(self.table),
+            "search": memory.search_usage(self.search),
+            "render_cache": self.app.render_cache.usage(
+                lambda key: key[0] == path),
+            }
+
+    def close(self):
+        self.jobs.cancel()
+        self.app.scheduler.owner_remove(self)
+        path = self.path
+        self.app.render_cache.drop(lambda key: key[0] == path)
+        self.doc = None
+        self.search = None
+
+
+class DocumentRegistry(object):
+
+    """The shared documents of an application, keyed by file identity
+
+    The same file opened through different paths, like symlinks, is
+    recognized by its device and inode numbers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.documents = {}
+
+    @staticmethod
+    def file_key(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return os.path.realpath(path)
+        return st.st_dev, st.st_ino
+
+    def acquire(self, path):
+        """Shared document of the file at path
+
+        Each caller must add itself with view_add and call release when
+        it goes away.
+        """
+        key = self.file_key(path)
+        shared = self.documents.get(key)
+        if shared is None:
+            shared = self.documents[key] = SharedDocument(self.app, key, path)
+        return shared
+
+    def release(self, shared, view):
+        """Remove a view, the document is freed with its last view"""
+        if view in shared.views:
+            shared.views.remove(view)
+        if shared.views:
+            return
+        if self.documents.get(shared.key) is shared:
+            del self.documents[shared.key]
+        shared.close()
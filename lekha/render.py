@@ -0,0 +1,209 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import logging
+
+from . import jobs
+from . import instrument
+from .util import process_pool
+
+log = logging.getLogger("lekha")
+
+
+class EvasRenderer(object):
+
+    """Renders pages with the evas generic PDF loader
+
+    Also the base of the other backends: image files, like cached
+    previews, are always loaded through evas. Completion is reported by
+    calling done_cb with the image in the main loop.
+    """
+
+    name = "evas"
+
+    def __init__(self):
+        self._callbacks = {}
+
+    def load(self, img, path, done_cb):
+        self.cancel(img)
+
+        def preloaded(img):
+            img.on_image_preloaded_del(preloaded)
+            del self._callbacks[img]
+            done_cb(img)
+
+        preloaded = instrument.timed(preloaded, "preload", "image preloaded")
+        self._callbacks[img] = preloaded
+        img.on_image_preloaded_add(preloaded)
+        img.file = path
+        img.preload()
+
+    def render(self, img, doc_path, page_num, done_cb):
+        self.load(img, (doc_path, str(page_num)), done_cb)
+
+    def cancel(self, img):
+        preloaded = self._callbacks.pop(img, None)
+        if preloaded is not None:
+            img.on_image_preloaded_del(preloaded)
+            img.preload(True)
+
+    def shutdown(self):
+        pass
+
+
+_canvas = None
+
+
+def _worker_init():
+    global _canvas
+    import efl.evas as evas
+    evas.init()
+    _canvas = evas.Canvas(method="buffer", size=(1, 1))
+
+
+def image_pixels(img):
+    """Size and ARGB pixels of an evas image, rows without padding"""
+    w, h = img.image_size
+    stride = img.stride
+    data = bytes(memoryview(img))
+    if stride != w * 4:
+        data = b"".join(
+            data[row * stride:row * stride + w * 4] for row in range(h))
+    return w, h, data
+
+
+def _render_page(doc_path, page_num, load_size, load_region):
+    """Rasterize a page in a worker process, return its ARGB pixels"""
+    from efl.evas import Image
+    img = Image(_canvas, load_dpi=1, load_size=load_size)
+    try:
+        if load_region is not None:
+            img.load_region = load_region
+        img.file = (doc_path, str(page_num))
+        if img.load_error:
+            raise IOError(
+                "page %d could not be rendered, error %d" % (
+                    page_num, img.load_error))
+        return image_pixels(img)
+    finally:
+        img.delete()
+
+
+def encode_image(path, w, h, data, flags=None):
+    """Save ARGB pixels as an image file in a worker process
+
+    The format follows the file name extension. Returns the size of the
+    file.
+    """
+    from efl.evas import Image
+    root, ext = os.path.splitext(path)
+    tmp_path = "%s.%d.tmp%s" % (root, os.getpid(), ext)
+    # evas uses the pixels in place, data is kept until the image is gone
+    data = bytearray(data)
+    img = Image(_canvas)
+    try:
+        img.image_size = w, h
+        img.image_data_set(data)
+        img.save(tmp_path, None, flags)
+    finally:
+        img.delete()
+    if not os.path.exists(tmp_path):
+        raise IOError("image %s could not be saved" % path)
+    os.rename(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def worker_pool(processes=None):
+    """A pool of worker processes with an evas buffer canvas"""
+    return process_pool(processes, _worker_init)
+
+
+class ProcessRenderer(EvasRenderer):
+
+    """Renders pages in a pool of worker processes
+
+    Each worker loads pages with evas on a buffer canvas and sends back
+    the pixels, which are then set as the image data in the main loop.
+    Pages render in parallel, one per worker.
+    """
+
+    name = "process"
+
+    def __init__(self, workers=None):
+        super(ProcessRenderer, self).__init__()
+        self.pool = worker_pool(workers)
+        self._jobs = {}
+        self._buffers = {}
+
+    def render(self, img, doc_path, page_num, done_cb):
+        self.cancel(img)
+        load_region = img.load_region
+        if not load_region[2] or not load_region[3]:
+            load_region = None
+
+        def rendered(result):
+            del self._jobs[img]
+            self._image_set(img, *result)
+            done_cb(img)
+
+        def render_error(e):
+            # like a failed evas preload, report the image as done
+            del self._jobs[img]
+            log.error("Page could not be rendered: %r", e)
+            done_cb(img)
+
+        self._jobs[img] = jobs.runner().submit(
+            self.pool, _render_page,
+            doc_path, page_num, tuple(img.load_size), load_region,
+            done_cb=rendered, error_cb=render_error)
+
+    def cancel(self, img):
+        super(ProcessRenderer, self).cancel(img)
+        job = self._jobs.pop(img, None)
+        if job is not None:
+            job.cancel()
+
+    def _image_set(self, img, w, h, data):
+        if img not in self._buffers:
+            img.on_del_add(self._image_deleted)
+        # evas uses the pixels in place, keep them alive with the image
+        data = self._buffers[img] = bytearray(data)
+        img.image_size = w, h
+        img.image_data_set(data)
+        img.image_data_update_add(0, 0, w, h)
+
+    def _image_deleted(self, img):
+        job = self._jobs.pop(img, None)
+        if job is not None:
+            job.cancel()
+        self._buffers.pop(img, None)
+
+    def shutdown(self):
+        for job in self._jobs.values():
+            job.cancel()
+        self._jobs.clear()
+        self.pool.terminate()
+
+
+RENDERERS = {
+    EvasRenderer.name: EvasRenderer,
+    ProcessRenderer.name: ProcessRenderer,
+    }
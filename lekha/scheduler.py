@@ -0,0 +1,210 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import logging
+import multiprocessing
+
+from efl.ecore import Idler
+
+from . import instrument
+
+log = logging.getLogger("lekha")
+
+#: Rendering pages in the viewport
+VISIBLE = 0
+#: Reading the outline tree and the named destinations
+OUTLINES = 1
+#: Building the page table
+POPULATE = 2
+#: Rendering pages ahead of the viewport
+PREFETCH = 3
+
+
+class Task(object):
+
+    def __init__(self, owner, kind, func, args):
+        self.owner = owner
+        self.kind = kind
+        self.func = func
+        self.args = args
+
+    def __repr__(self):
+        return "<%s(%r, %d)>" % (
+            self.__class__.__name__, self.func.__name__, self.kind)
+
+
+class RenderRequest(object):
+
+    def __init__(
+            self, owner, priority_cb, backend, img, doc_path, page_num,
+            done_cb):
+        self.owner = owner
+        self.priority_cb = priority_cb
+        self.backend = backend
+        self.img = img
+        self.doc_path = doc_path
+        self.page_num = page_num
+        self.done_cb = done_cb
+
+    @property
+    def kind(self):
+        return self.priority_cb(self.page_num)
+
+
+class Scheduler(object):
+
+    """Application wide queue for the main loop work of all documents
+
+    Idle tasks, like page population, run one step at a time from a
+    single idler, and page renders are started only while fewer than
+    max_renders are in flight. Both always pick the work of the selected
+    tab first, then the most urgent kind of work. Work of the background
+    tabs only runs when the selected one has none left.
+    """
+
+    #: Seconds of idle tasks to run per main loop iteration
+    TIME_SLICE = 0.008
+
+    def __init__(self, foreground_cb, max_renders=None):
+        # foreground_cb returns the owners of the work of the selected tab
+        self.foreground_cb = foreground_cb
+        if max_renders is None:
+            max_renders = multiprocessing.cpu_count()
+        self.max_renders = max_renders
+        self.tasks = []
+        self.renders = []
+        self.in_flight = {}
+        self._idler = None
+
+    def _key(self, work, foreground):
+        for owner in foreground:
+            if work.owner is owner:
+                return 0, work.kind
+        return 1, work.kind
+
+    def _best(self, queue):
+        foreground = self.foreground_cb()
+        return min(queue, key=lambda work: self._key(work, foreground))
+
+    def idle_add(self, owner, kind, func, *args):
+        """Run func(*args) when idle until it returns False"""
+        task = Task(owner, kind, instrument.timed(func, "idle"), args)
+        self.tasks.append(task)
+        if self._idler is None:
+            self._idler = Idler(instrument.timed(self._idle, "idler"))
+        return task
+
+    def idle_del(self, task):
+        try:
+            self.tasks.remove(task)
+        except ValueError:
+            pass
+
+    def _idle(self):
+        end = time.time() + self.TIME_SLICE
+        while self.tasks and time.time() < end:
+            task = self._best(self.tasks)
+            try:
+                keep = task.func(*task.args)
+            except Exception:
+                log.exception("%r failed", task)
+                keep = False
+            if not keep:
+                self.idle_del(task)
+        if not self.tasks:
+            self._idler = None
+            return False
+        return True
+
+    def renderer(self, owner, backend, priority_cb):
+        """A renderer for owner queueing its renders in this scheduler
+
+        priority_cb(page_num) gives the kind of a render, VISIBLE or
+        PREFETCH.
+        """
+        return ScheduledRenderer(self, owner, backend, priority_cb)
+
+    def render_add(self, request):
+        self.renders.append(request)
+        self.reschedule()
+
+    def render_cancel(self, img):
+        for request in self.renders:
+            if request.img is img:
+                self.renders.remove(request)
+                return
+        request = self.in_flight.pop(img, None)
+        if request is not None:
+            request.backend.cancel(img)
+            self.reschedule()
+
+    def _render_done(self, img):
+        request = self.in_flight.pop(img, None)
+        if request is not None:
+            request.done_cb(img)
+        self.reschedule()
+
+    def reschedule(self):
+        """Start queued renders, call when priorities may have changed"""
+        while self.renders and len(self.in_flight) < self.max_renders:
+            request = self._best(self.renders)
+            self.renders.remove(request)
+            self.in_flight[request.img] = request
+            request.backend.render(
+                request.img, request.doc_path, request.page_num,
+                self._render_done)
+        if self.tasks and self._idler is None:
+            self._idler = Idler(instrument.timed(self._idle, "idler"))
+
+    def owner_remove(self, owner):
+        """Drop all queued work of owner"""
+        self.tasks = [t for t in self.tasks if t.owner is not owner]
+        self.renders = [r for r in self.renders if r.owner is not owner]
+        for img, request in list(self.in_flight.items()):
+            if request.owner is owner:
+                del self.in_flight[img]
+                request.backend.cancel(img)
+        self.reschedule()
+
+
+class ScheduledRenderer(object):
+
+    """Renderer interface of one owner on top of a Scheduler"""
+
+    def __init__(self, scheduler, owner, backend, priority_cb):
+        self.scheduler = scheduler
+        self.owner = owner
+        self.backend = backend
+        self.priority_cb = priority_cb
+
+    def load(self, img, path, done_cb):
+        self.cancel(img)
+        self.backend.load(img, path, done_cb)
+
+    def render(self, img, doc_path, page_num, done_cb):
+        self.cancel(img)
+        self.scheduler.render_add(RenderRequest(
+            self.owner, self.priority_cb, self.backend, img, doc_path,
+            page_num, done_cb))
+
+    def cancel(self, img):
+        self.backend.cancel(img)
+        self.scheduler.render_cancel(img)
@@ -0,0 +1,258 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Full-text search of documents
+
+Page text is extracted with PyPDF2 in a pool of worker processes, a few
+pages per job, into an inverted index mapping each term to the pages and
+text offsets it appears at. Finished indexes are saved in the XDG cache
+keyed by the document fingerprint, so a document is indexed once.
+"""
+
+import os
+import re
+import gzip
+import json
+import logging
+
+from xdg import BaseDirectory
+
+from . import parser as doc_parser
+from .util import process_pool, write_atomic
+
+log = logging.getLogger("lekha")
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_reader = None
+
+
+def _pages_index(path, password, first, last):
+    """Postings of the pages first to last - 1, run in a worker process
+
+    Returns a dict mapping terms to flat lists of page, offset pairs.
+    """
+    global _reader
+    # a worker indexes chunks of the same document in a row, keep it open
+    if _reader is None or _reader[0] != path:
+        doc = doc_parser.reader(path)
+        if doc.isEncrypted:
+            doc.decrypt(password or b"")
+        _reader = path, doc
+    doc = _reader[1]
+    postings = {}
+    for pg_num in range(first, last):
+        try:
+            text = doc.getPage(pg_num).extractText()
+        except Exception as e:
+            log.info("text of page %d could not be extracted: %r", pg_num, e)
+            continue
+        for m in WORD_RE.finditer(text.lower()):
+            postings.setdefault(m.group(), []).extend((pg_num, m.start()))
+    return postings
+
+
+def _index_load(path, version, page_count):
+    """Terms of a saved index, or None, run in a worker process"""
+    try:
+        with gzip.open(path, "rb") as fp:
+            entry = json.loads(fp.read().decode("utf-8"))
+    except (IOError, OSError):
+        return None
+    if (
+            entry.get("version") != version or
+            entry.get("page_count") != page_count):
+        return None
+    return entry["terms"]
+
+
+def _index_save(path, entry):
+    """Save an index, run in a worker process"""
+    write_atomic(path, json.dumps(entry).encode("utf-8"), gzip.open)
+
+
+_pool = None
+
+
+def pool():
+    """The worker process pool extracting page text"""
+    global _pool
+    if _pool is None:
+        _pool = process_pool()
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+class SearchIndex(object):
+
+    """Inverted index of the text of one document
+
+    Built in the background after start(), the progress callbacks
+    progress_cb(indexed, total) are called in the main loop as pages are
+    added. Searching works on the pages indexed so far. The pages of a
+    chunk that could not be extracted count as indexed, without text,
+    and an index missing them is not saved. The text of encrypted
+    documents is not saved either.
+
+    The JSON of the saved indexes is decoded and encoded in the worker
+    processes, not in the main process.
+    """
+
+    VERSION = 1
+    #: Pages per extraction job
+    CHUNK = 20
+
+    def __init__(
+            self, path, page_count, fingerprint, group, password=None,
+            base_path=None):
+        if base_path is None:
+            base_path = BaseDirectory.save_cache_path("lekha", "search")
+        self.base_path = base_path
+        self.path = path
+        self.page_count = page_count
+        self.fingerprint = fingerprint
+        self.group = group
+        self.password = password
+        self.terms = {}
+        self.indexed = 0
+        self.started = False
+        self.failed = False
+        self.progress_cbs = []
+        self._results = {}
+
+    @property
+    def complete(self):
+        return self.indexed >= self.page_count
+
+    def _cache_path(self):
+        return os.path.join(self.base_path, self.fingerprint + ".json.gz")
+
+    def start(self, progress_cb=None):
+        """Load the index from the cache or start building it"""
+        if progress_cb is not None and progress_cb not in self.progress_cbs:
+            self.progress_cbs.append(progress_cb)
+        if self.started:
+            return
+        self.started = True
+        if self.fingerprint is None or self.password is not None:
+            self._build()
+            return
+        self.group.submit(
+            pool(), _index_load, self._cache_path(), self.VERSION,
+            self.page_count, done_cb=self._loaded, error_cb=self._load_error)
+
+    def _loaded(self, terms):
+        if terms is None:
+            self._build()
+            return
+        self.terms = terms
+        self._changed(self.page_count)
+
+    def _load_error(self, e):
+        log.info("search index could not be loaded: %r", e)
+        self._build()
+
+    def _build(self):
+        for first in range(0, self.page_count, self.CHUNK):
+            last = min(first + self.CHUNK, self.page_count)
+            self.group.submit(
+                pool(), _pages_index, self.path, self.password, first, last,
+                done_cb=lambda postings, n=last - first:
+                    self._merge(postings, n),
+                error_cb=lambda e, first=first, last=last:
+                    self._build_error(e, first, last))
+
+    def _build_error(self, e, first, last):
+        log.error(
+            "Text of pages %d to %d could not be indexed: %r",
+            first + 1, last, e)
+        # the index still completes, without the text of these pages
+        self.failed = True
+        self._merge({}, last - first)
+
+    def _merge(self, postings, count):
+        terms = self.terms
+        for term, pairs in postings.items():
+            if term in terms:
+                terms[term].extend(pairs)
+            else:
+                terms[term] = pairs
+        self._changed(self.indexed + count)
+        if (
+                self.complete and not self.failed and
+                self.fingerprint is not None and self.password is None):
+            entry = {
+                "version": self.VERSION,
+                "page_count": self.page_count,
+                "terms": terms,
+                }
+            self.group.submit(
+                pool(), _index_save, self._cache_path(), entry,
+                error_cb=self._save_error)
+
+    def _changed(self, indexed):
+        self.indexed = indexed
+        self._results.clear()
+        for progress_cb in self.progress_cbs:
+            progress_cb(self.indexed, self.page_count)
+
+    def _save_error(self, e):
+        log.info("search index could not be saved: %r", e)
+
+    def search(self, query):
+        """Pages containing all the words of query
+
+        Returns a list of (page number, number of hits) sorted by page.
+        """
+        words = tuple(WORD_RE.findall(query.lower()))
+        if not words:
+            return []
+        results = self._results.get(words)
+        if results is not None:
+            return results
+
+        pages = None
+        hits = {}
+        for word in words:
+            pairs = self.terms.get(word, ())
+            word_pages = set(pairs[0::2])
+            if pages is None:
+                pages = word_pages
+            else:
+                pages &= word_pages
+            for pg_num in pairs[0::2]:
+                hits[pg_num] = hits.get(pg_num, 0) + 1
+
+        results = self._results[words] = [
+            (pg_num, hits[pg_num]) for pg_num in sorted(pages)]
+        return results
+
+    def offsets(self, word, pg_num):
+        """Text offsets of a word on a page"""
+        pairs = self.terms.get(word.lower(), ())
+        return [
+            pairs[i + 1] for i in range(0, len(pairs), 2)
+            if pairs[i] == pg_num]
@@ -0,0 +1,63 @@
+# encoding: utf-8
+#
+#  Lekha - A PDF document viewer
+#
+#  Copyright 2015 Kai Huuhko <kai.huuhko@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Helpers of the modules that run without EFL, in worker processes too"""
+
+import os
+import traceback
+import multiprocessing
+
+
+def call(func, args, kwargs):
+    """Run func in a worker process, return (result, error, traceback)
+
+    The jobs of the main loop send this to the pools, the workers then
+    import this module and the one of func, not the job runner.
+    """
+    try:
+        return func(*args, **kwargs), None, None
+    except Exception as e:
+        return None, e, traceback.format_exc()
+
+
+def process_pool(processes=None, initializer=None):
+    """A multiprocessing pool of freshly started interpreters
+
+    The workers are spawned where possible instead of forked, so they do
+    not inherit the main loop, its file descriptors and EFL state.
+    """
+    try:
+        ctx = multiprocessing.get_context("spawn")
+    except AttributeError:
+        # Python 2 can only fork
+        ctx = multiprocessing
+    return ctx.Pool(processes, initializer)
+
+
+def write_atomic(path, data, opener=open):
+    """Replace the file at path with data, readers never see a partial file
+
+    The data is written to a temporary file next to path, which is then
+    renamed over it. opener opens the temporary file, like gzip.open.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with opener(tmp_path, "wb") as fp:
+        fp.write(data)
+    os.rename(tmp_path, path)
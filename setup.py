@@ -20,7 +20,7 @@ setup(
         'Topic :: Other/Nonlisted Topic',
         ],
     packages=['lekha'],
-    scripts=['bin/lekha'],
+    scripts=['bin/lekha', 'bin/lekha-bench'],
     data_files=[('/usr/share/applications', ['lekha.desktop'])],
     requires=[
         "efl (>=1.14.0)",